@@ -0,0 +1,4 @@
+from projects.asgi import create_asgi_app
+
+# read-only API routes only, see projects/asgi.py; run with an ASGI server, e.g. `uvicorn asgi:app`
+app = create_asgi_app()
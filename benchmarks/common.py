@@ -0,0 +1,30 @@
+import os
+import sys
+import types
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+
+def configure(db_path, **settings):
+    """Create the application using the SQLite database at db_path and return it, with its context pushed.
+
+    The application is configured from settings rather than the deployment configuration.
+
+    """
+
+    config = types.ModuleType('config')
+    config.SECRET_KEY = 'benchmark'
+    config.WTF_CSRF_ENABLED = False
+    config.SQLALCHEMY_DATABASE_URI = 'sqlite:///%s' % os.path.abspath(db_path)
+    config.SQLALCHEMY_TRACK_MODIFICATIONS = False
+    config.METRICS_ENABLED = False
+    for key, value in settings.items():
+        setattr(config, key, value)
+
+    from projects import create_app
+
+    app = create_app(config)
+    # so the seeding and benchmark code can use the database directly
+    app.app_context().push()
+
+    return app
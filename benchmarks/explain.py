@@ -0,0 +1,139 @@
+"""
+Query plan check for the main read routes.
+
+Seeds a local SQLite database (see seed.py), requests each route benchmarked by run.py through Flask's test client,
+and runs EXPLAIN QUERY PLAN on every statement the requests issued. Exits with status 1 if any statement scans a
+whole table rather than searching an index, or sorts its rows for an ORDER BY rather than reading them in index order,
+so it can guard against regressions when queries or indexes change:
+
+    python benchmarks/explain.py --projects 200 --posts 10
+
+Scans of a whole index (e.g. "SCAN projects USING INDEX ...") are reported but allowed.
+"""
+
+import os
+import random
+import re
+import sys
+from argparse import ArgumentParser
+
+sys.path.append(os.path.dirname(__file__))
+
+from common import configure
+from run import build_routes
+from seed import add_seed_arguments, seed
+
+
+# routes checked in addition to those benchmarked, as (route name, url generator) pairs
+EXTRA_ROUTES = [
+    ('get_changes', lambda rng: '/api/changes'),
+    ('site_feed', lambda rng: '/feed.atom'),
+]
+
+# SQLite reports a full table scan as e.g. "SCAN projects", or "SCAN TABLE projects" before 3.24
+TABLE_SCAN = re.compile(r'^SCAN (TABLE )?(?P<table>\w+)$')
+# rows sorted after they were fetched, e.g. because no index matches the ORDER BY
+ORDER_BY_SORT = 'USE TEMP B-TREE FOR ORDER BY'
+
+
+def explain(connection, statement, parameters):
+    """Return the detail lines of the SQLite query plan of statement."""
+
+    cursor = connection.cursor()
+    try:
+        cursor.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+        # the detail is the last column in every SQLite version
+        return [row[-1] for row in cursor.fetchall()]
+    finally:
+        cursor.close()
+
+
+def main():
+    """Seed a database and check the query plans of the read routes against it."""
+
+    parser = ArgumentParser()
+    add_seed_arguments(parser)
+    parser.add_argument("--skip-seed", dest="skip_seed", action="store_true",
+                        help="reuse the existing database instead of seeding it again")
+    parser.add_argument("--requests", dest="requests", type=int, default=5, help="requests per route")
+    parser.add_argument("-v", "--verbose", dest="verbose", action="store_true",
+                        help="print the plan of every statement, not just those with table scans")
+
+    args = parser.parse_args()
+
+    # the change feed holds back recent changes, which would leave it nothing to query on a freshly seeded database
+    app = configure(args.db, CHANGES_DELAY=0)
+
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    from projects import db
+    from projects.models import User
+
+    if not args.skip_seed:
+        seed(users=args.users, projects=args.projects, posts=args.posts, body_size=args.body_size,
+             seed_value=args.seed)
+
+    client = app.test_client()
+    response = client.post('/login', data={'username': 'user0', 'password': 'password'})
+    if response.status_code != 302:
+        raise RuntimeError('Could not log in as user0, is the database seeded?')
+
+    user_id = User.query.filter_by(username='user0').first().id
+
+    captured = []
+
+    @event.listens_for(Engine, 'before_cursor_execute')
+    def capture_statement(conn, cursor, statement, parameters, context, executemany):
+        if not executemany and statement.lstrip().upper().startswith(('SELECT', 'UPDATE', 'DELETE')):
+            captured.append((statement, parameters))
+
+    rng = random.Random(args.seed)
+    plans = {}
+    for name, make_url in build_routes(user_id) + EXTRA_ROUTES:
+        del captured[:]
+        for _ in range(args.requests):
+            url = make_url(rng)
+            response = client.get(url)
+            if response.status_code != 200:
+                raise RuntimeError('%s returned %d' % (url, response.status_code))
+
+        for statement, parameters in captured:
+            # the same statement is issued with different parameters, the first is enough to get its plan
+            plans.setdefault((name, statement), parameters)
+
+    event.remove(Engine, 'before_cursor_execute', capture_statement)
+
+    connection = db.engine.raw_connection()
+    failures = 0
+    try:
+        for (name, statement), parameters in sorted(plans.items(), key=lambda item: item[0][0]):
+            details = explain(connection, statement, parameters)
+            scans = [match.group('table') for match in (TABLE_SCAN.match(detail) for detail in details) if match]
+            sorts = ORDER_BY_SORT in details
+
+            if scans or sorts:
+                failures += 1
+                problems = ['scans %s' % ', '.join(scans)] if scans else []
+                if sorts:
+                    problems.append('sorts its rows for the ORDER BY')
+                print('[ERROR] %s %s:' % (name, ' and '.join(problems)))
+            elif args.verbose:
+                print('[INFO] %s:' % name)
+            else:
+                continue
+
+            print('    ' + ' '.join(statement.split()))
+            for detail in details:
+                print('      ' + detail)
+    finally:
+        connection.close()
+
+    print('[INFO] Checked %d statements of %d routes, %d with table scans or sorts.' % (
+        len(plans), len(set(name for name, _ in plans)), failures))
+
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
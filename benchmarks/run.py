@@ -0,0 +1,228 @@
+"""
+Benchmarks for the main read routes.
+
+Seeds a local SQLite database with synthetic data (see seed.py), then drives the index, view_project, view_post,
+get_projects, get_project and get_post routes through Flask's test client and reports, per route, throughput,
+latency percentiles, SQL statements per request and peak memory as JSON. The same arguments always produce the same
+dataset and request sequence, so results can be compared between commits:
+
+    python benchmarks/run.py --projects 1000 --posts 50 --output before.json
+
+Peak memory is measured with tracemalloc in a separate pass, so its overhead does not affect the latencies.
+
+Startup time is measured by starting fresh interpreters that import the application package and create the app, as
+every uWSGI worker does when it starts or reloads. Only startup is measured with --startup-only.
+"""
+
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+import tracemalloc
+from argparse import ArgumentParser
+
+sys.path.append(os.path.dirname(__file__))
+
+from common import configure
+from seed import add_seed_arguments, seed
+
+
+def percentile(values, fraction):
+    """Nearest rank percentile of a sorted list of values."""
+
+    index = max(int(round(fraction * len(values))) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(__file__),
+                                       stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build_routes(user_id):
+    """Return (route name, url generator) pairs, each generator picking a url from the seeded data."""
+
+    from projects import db
+    from projects.models import Project, Post
+
+    projects = db.session.query(Project.name, Project.private).filter_by(user_id=user_id).order_by(Project.id).all()
+    posts = db.session.query(Project.name, Post.post_id, Project.private, Post.private).join(
+        Project, Post.project_id == Project.id).filter(Project.user_id == user_id).order_by(Post.id).all()
+
+    project_names = [name for name, _ in projects]
+    public_projects = [name for name, private in projects if not private]
+    post_ids = [(name, post_id) for name, post_id, _, _ in posts]
+    public_posts = [(name, post_id) for name, post_id, project_private, private in posts
+                    if not project_private and not private]
+
+    return [
+        ('index', lambda rng: '/index'),
+        ('view_project', lambda rng: '/project/%s' % rng.choice(project_names)),
+        ('view_post', lambda rng: '/project/%s/post/%d' % rng.choice(post_ids)),
+        ('get_projects', lambda rng: '/api/projects'),
+        ('get_project', lambda rng: '/api/project?name=%s' % rng.choice(public_projects)),
+        ('get_post', lambda rng: '/api/post?name=%s&id=%d' % rng.choice(public_posts)),
+    ]
+
+
+# run in a fresh interpreter, printing the seconds taken to import the package and to create the app
+STARTUP_SCRIPT = '''
+import sys, time
+sys.path.insert(0, %(benchmarks)r)
+from common import configure
+started = time.perf_counter()
+import projects
+imported = time.perf_counter()
+configure(%(db)r)
+print(imported - started, time.perf_counter() - imported)
+'''
+
+
+def benchmark_startup(db_path, runs):
+    """Measure the cold start time of the application over runs fresh interpreters."""
+
+    script = STARTUP_SCRIPT % {'benchmarks': os.path.dirname(os.path.abspath(__file__)), 'db': db_path}
+
+    import_times = []
+    create_times = []
+    for _ in range(runs):
+        output = subprocess.check_output([sys.executable, '-c', script]).decode('ascii').split()
+        import_times.append(float(output[0]))
+        create_times.append(float(output[1]))
+
+    totals = sorted(import_time + create_time for import_time, create_time in zip(import_times, create_times))
+    return {
+        'runs': runs,
+        'import_ms': round(percentile(sorted(import_times), 0.50) * 1000, 3),
+        'create_app_ms': round(percentile(sorted(create_times), 0.50) * 1000, 3),
+        'total_ms': {
+            'min': round(totals[0] * 1000, 3),
+            'p50': round(percentile(totals, 0.50) * 1000, 3),
+            'max': round(totals[-1] * 1000, 3),
+        },
+    }
+
+
+def benchmark_route(client, make_url, requests, warmup, seed_value, statements):
+    """Run requests against one route and return its measurements."""
+
+    rng = random.Random(seed_value)
+    urls = [make_url(rng) for _ in range(warmup + requests)]
+
+    for url in urls[:warmup]:
+        client.get(url)
+
+    latencies = []
+    statements[0] = 0
+    started = time.perf_counter()
+    for url in urls[warmup:]:
+        request_started = time.perf_counter()
+        response = client.get(url)
+        latencies.append(time.perf_counter() - request_started)
+        if response.status_code != 200:
+            raise RuntimeError('%s returned %d' % (url, response.status_code))
+    elapsed = time.perf_counter() - started
+    statement_count = statements[0]
+
+    # separate pass for memory, as tracing allocations slows every request down
+    tracemalloc.start()
+    for url in urls[warmup:warmup + min(requests, 50)]:
+        client.get(url)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'throughput_rps': round(requests / elapsed, 1),
+        'latency_ms': {
+            'mean': round(sum(latencies) / len(latencies) * 1000, 3),
+            'p50': round(percentile(latencies, 0.50) * 1000, 3),
+            'p99': round(percentile(latencies, 0.99) * 1000, 3),
+            'max': round(latencies[-1] * 1000, 3),
+        },
+        'statements_per_request': round(statement_count / float(requests), 2),
+        'peak_memory_kb': round(peak_memory / 1024.0, 1),
+    }
+
+
+def main():
+    """Seed a database and benchmark the read routes against it."""
+
+    parser = ArgumentParser()
+    add_seed_arguments(parser)
+    parser.add_argument("--skip-seed", dest="skip_seed", action="store_true",
+                        help="reuse the existing database instead of seeding it again")
+    parser.add_argument("--requests", dest="requests", type=int, default=200, help="measured requests per route")
+    parser.add_argument("--warmup", dest="warmup", type=int, default=10, help="unmeasured requests per route")
+    parser.add_argument("--routes", dest="routes", nargs='*', help="only benchmark these routes")
+    parser.add_argument("--startup-runs", dest="startup_runs", type=int, default=5,
+                        help="number of fresh interpreters to measure startup time with, 0 to skip")
+    parser.add_argument("--startup-only", dest="startup_only", action="store_true",
+                        help="only measure startup time, without seeding or benchmarking routes")
+    parser.add_argument("--output", dest="output", help="file to write the JSON results to, defaults to stdout")
+
+    args = parser.parse_args()
+
+    startup = benchmark_startup(args.db, args.startup_runs) if args.startup_runs > 0 else None
+    if args.startup_only:
+        write_report({'revision': git_revision(), 'python': platform.python_version(), 'startup': startup},
+                     args.output)
+        return
+
+    app = configure(args.db)
+
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    dataset = None
+    if not args.skip_seed:
+        dataset = seed(users=args.users, projects=args.projects, posts=args.posts, body_size=args.body_size,
+                       seed_value=args.seed)
+
+    statements = [0]
+
+    @event.listens_for(Engine, 'after_cursor_execute')
+    def count_statement(*args):
+        statements[0] += 1
+
+    client = app.test_client()
+    response = client.post('/login', data={'username': 'user0', 'password': 'password'})
+    if response.status_code != 302:
+        raise RuntimeError('Could not log in as user0, is the database seeded?')
+
+    from projects.models import User
+    user_id = User.query.filter_by(username='user0').first().id
+
+    results = {}
+    for name, make_url in build_routes(user_id):
+        if args.routes and name not in args.routes:
+            continue
+        results[name] = benchmark_route(client, make_url, args.requests, args.warmup, args.seed, statements)
+
+    write_report({
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'dataset': dataset,
+        'startup': startup,
+        'routes': results,
+    }, args.output)
+
+
+def write_report(report, path):
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if path:
+        with open(path, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
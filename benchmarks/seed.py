@@ -0,0 +1,153 @@
+import datetime
+import random
+import sys
+import os
+from argparse import ArgumentParser
+
+sys.path.append(os.path.dirname(__file__))
+
+from common import configure
+
+
+# number of distinct markdown bodies generated; bodies are reused so html only has to be rendered once per body
+BODY_POOL_SIZE = 50
+
+WORDS = ['lorem', 'ipsum', 'dolor', 'sit', 'amet', 'consectetur', 'adipiscing', 'elit', 'sed', 'do', 'eiusmod',
+         'tempor', 'incididunt', 'ut', 'labore', 'et', 'dolore', 'magna', 'aliqua', 'enim', 'minim', 'veniam',
+         'quis', 'nostrud', 'exercitation', 'ullamco', 'laboris', 'nisi', 'aliquip', 'commodo', 'consequat']
+
+
+def generate_body(rng, size):
+    """Return a markdown document of roughly size characters, with headings, lists, emphasis, links and code."""
+
+    def sentence():
+        words = [rng.choice(WORDS) for _ in range(rng.randint(6, 16))]
+        if rng.random() < 0.3:
+            index = rng.randrange(len(words))
+            words[index] = '*%s*' % words[index]
+        if rng.random() < 0.1:
+            words.append('[link](http://example.com/%s)' % rng.choice(WORDS))
+        return ' '.join(words).capitalize() + '.'
+
+    blocks = []
+    length = 0
+    while length < size:
+        kind = rng.random()
+        if kind < 0.1:
+            block = '## ' + sentence()
+        elif kind < 0.25:
+            block = '\n'.join('- ' + sentence() for _ in range(rng.randint(2, 5)))
+        elif kind < 0.3:
+            block = '```\n%s\n```' % '\n'.join('%s = %d' % (rng.choice(WORDS), i) for i in range(rng.randint(2, 6)))
+        else:
+            block = ' '.join(sentence() for _ in range(rng.randint(2, 6)))
+        blocks.append(block)
+        length += len(block) + 2
+
+    return '\n\n'.join(blocks)[:max(size, 1)]
+
+
+def seed(users=1, projects=100, posts=20, body_size=2000, seed_value=0, batch_size=1000):
+    """Drop and recreate all tables, then fill them with synthetic users, projects and posts.
+
+    Parameters
+    ----------
+    users
+        Number of users; user<n> with password 'password'.
+    projects
+        Number of projects per user.
+    posts
+        Number of posts per project.
+    body_size
+        Approximate size in characters of each project and post body.
+    seed_value
+        Seed of the random generator, the same seed always produces the same data.
+    batch_size
+        Number of rows inserted per statement.
+
+    Returns a dict describing the dataset.
+
+    """
+
+    from projects import db, search
+    from projects.helpers import render_markdown
+    from projects.models import User, Project, Post
+
+    rng = random.Random(seed_value)
+    bodies = [generate_body(rng, body_size) for _ in range(BODY_POOL_SIZE)]
+    rendered = [render_markdown(body) for body in bodies]
+    started = datetime.datetime(2017, 1, 1)
+
+    db.drop_all()
+    db.create_all()
+
+    for user_number in range(users):
+        db.session.add(User(username='user%d' % user_number, password='password'))
+    db.session.commit()
+
+    rows = []
+    timestamp = started
+    for user_id, in db.session.query(User.id).order_by(User.id):
+        for project_number in range(projects):
+            body = rng.randrange(BODY_POOL_SIZE)
+            timestamp += datetime.timedelta(minutes=rng.randint(1, 600))
+            rows.append({
+                'name': 'Bench%dProject%d' % (user_id, project_number), 'title': 'Project %d' % project_number,
+                'body': bodies[body], 'body_html': rendered[body], 'created': timestamp,
+                'edited': timestamp if rng.random() < 0.5 else None, 'modified': timestamp,
+                'private': rng.random() < 0.2,
+                'next_post_id': posts + 1, 'user_id': user_id,
+            })
+    for start in range(0, len(rows), batch_size):
+        db.session.execute(Project.__table__.insert(), rows[start:start + batch_size])
+    db.session.commit()
+
+    rows = []
+    projects_query = db.session.query(Project.id, Project.title, Project.created, Project.user_id).order_by(Project.id)
+    for project_id, title, created, user_id in projects_query:
+        for post_id in range(1, posts + 1):
+            body = rng.randrange(BODY_POOL_SIZE)
+            rows.append({
+                'post_id': post_id, 'title': title, 'body': bodies[body], 'body_html': rendered[body],
+                'created': created + datetime.timedelta(hours=post_id), 'edited': None,
+                'modified': created + datetime.timedelta(hours=post_id), 'private': rng.random() < 0.2,
+                'project_id': project_id, 'user_id': user_id,
+            })
+            if len(rows) >= batch_size:
+                db.session.execute(Post.__table__.insert(), rows)
+                rows = []
+    if rows:
+        db.session.execute(Post.__table__.insert(), rows)
+    db.session.commit()
+
+    search.rebuild(batch_size=batch_size)
+
+    return {'users': users, 'projects_per_user': projects, 'posts_per_project': posts, 'body_size': body_size,
+            'seed': seed_value}
+
+
+def main():
+    """Seed a benchmark database with synthetic data."""
+
+    parser = ArgumentParser()
+    add_seed_arguments(parser)
+    args = parser.parse_args()
+
+    configure(args.db)
+    print(seed(users=args.users, projects=args.projects, posts=args.posts, body_size=args.body_size,
+               seed_value=args.seed))
+
+
+def add_seed_arguments(parser):
+    parser.add_argument("--db", dest="db", default=os.path.join(os.path.dirname(__file__), 'benchmark.db'),
+                        help="path of the SQLite database to (re)create")
+    parser.add_argument("--users", dest="users", type=int, default=1, help="number of users")
+    parser.add_argument("--projects", dest="projects", type=int, default=100, help="number of projects per user")
+    parser.add_argument("--posts", dest="posts", type=int, default=20, help="number of posts per project")
+    parser.add_argument("--body-size", dest="body_size", type=int, default=2000,
+                        help="approximate size in characters of each project and post body")
+    parser.add_argument("--seed", dest="seed", type=int, default=0, help="seed of the random data generator")
+
+
+if __name__ == '__main__':
+    main()
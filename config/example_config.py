@@ -21,5 +21,112 @@ SECRET_KEY = os.urandom(24)
 # Set this to the URI to the database that you wish to use for this application
 SQLALCHEMY_DATABASE_URI = ""
 
+# Optional read replicas of the database, as a list of URIs. GET requests of the viewer and API routes read from them
+# round-robin, checking each replica's health every REPLICA_CHECK_INTERVAL seconds. After a change, a browser session
+# keeps reading from the primary for REPLICA_READ_YOUR_WRITES seconds so it sees its own writes.
+SQLALCHEMY_REPLICA_URIS = []
+REPLICA_CHECK_INTERVAL = 30
+REPLICA_READ_YOUR_WRITES = 10
+
+# Database the async read-only API server (asgi.py) reads from, SQLALCHEMY_DATABASE_URI if None, and the size of its
+# connection pool. It needs asyncpg for PostgreSQL or aiosqlite for SQLite.
+ASYNC_API_DATABASE_URI = None
+ASYNC_API_POOL_SIZE = 20
+
 SQLALCHEMY_MIGRATE_REPO = os.path.join(basedir, 'db_repository')
 SQLALCHEMY_TRACK_MODIFICATIONS = False
+
+# Number of projects shown per page on the index and returned per page by the API, and the largest page the API allows
+PROJECTS_PER_PAGE = 20
+MAX_PROJECTS_PER_PAGE = 100
+
+# Number of times to retry allocating a post_id for a new post if it conflicts with an existing post
+POST_ID_RETRIES = 3
+
+# Hide deleted projects immediately and purge their rows with a background job, DELETE_BATCH_SIZE posts at a time
+DEFERRED_DELETE = False
+DELETE_BATCH_SIZE = 1000
+
+# Included in every ETag; change it to invalidate clients' cached responses, e.g. after changing templates
+CACHE_VERSION = '0.1.0'
+
+# Full text search over projects and posts; only available with SQLite (FTS5) or PostgreSQL databases
+SEARCH_ENABLED = True
+SEARCH_RESULTS_PER_PAGE = 20
+SEARCH_MAX_RESULTS = 1000
+
+# Number of rows fetched from the database at a time when streaming an export
+EXPORT_BATCH_SIZE = 1000
+
+# Number of times to retry creating a project if its generated name is taken by a concurrent request
+PAGE_NAME_RETRIES = 3
+
+# Number of verified API tokens cached per process, and for how many seconds
+API_TOKEN_CACHE_SIZE = 1024
+API_TOKEN_CACHE_TTL = 60
+
+# Number of logged in users whose id, username and session version are cached per process, and for how many seconds.
+# Sessions ended with logout/all may keep working for up to that long in other processes.
+SESSION_USER_CACHE_SIZE = 1024
+SESSION_USER_CACHE_TTL = 60
+
+# Login attempts allowed per minute from each client IP and for each username, and how many can be made at once
+LOGIN_IP_ATTEMPTS_PER_MINUTE = 20
+LOGIN_IP_BURST = 20
+LOGIN_USERNAME_ATTEMPTS_PER_MINUTE = 5
+LOGIN_USERNAME_BURST = 10
+
+# Number of threads per process checking password hashes, how many checks may run or wait at once before further
+# logins are rejected, and how many seconds a login waits for its check
+PASSWORD_WORKERS = 2
+PASSWORD_QUEUE_SIZE = 8
+PASSWORD_TIMEOUT = 5
+
+# pbkdf2 rounds of new password hashes; existing hashes are upgraded when their users log in. None for the default.
+PASSWORD_ROUNDS = None
+
+# Serve per-process request, SQL and markdown metrics in the Prometheus text format on /metrics. The route needs no
+# login, so it is disabled by default; only enable it if the web server keeps /metrics from being reached publicly
+METRICS_ENABLED = False
+# Log requests slower than this many seconds with the SQL statements they issued, or None to disable
+SLOW_REQUEST_THRESHOLD = None
+
+# Compress text responses of at least COMPRESSION_MIN_SIZE bytes with gzip, or brotli if the brotli package is installed
+COMPRESSION_ENABLED = True
+COMPRESSION_MIN_SIZE = 500
+COMPRESSION_LEVEL = 6
+COMPRESSION_BROTLI_QUALITY = 5
+# Number of compressed responses cached per process, and for how many seconds
+COMPRESSION_CACHE_SIZE = 256
+COMPRESSION_CACHE_TTL = 300
+
+# Run background jobs (html rendering, search indexing, purges) on TASK_WORKERS threads in each web process. Set
+# TASKS_IN_PROCESS to False to only run them with scripts/worker.py. Failed jobs are retried TASK_MAX_ATTEMPTS times,
+# waiting TASK_RETRY_DELAY seconds, doubled on every attempt, and jobs running for over TASK_TIMEOUT seconds are retried
+TASKS_IN_PROCESS = True
+TASK_WORKERS = 2
+TASK_MAX_ATTEMPTS = 5
+TASK_RETRY_DELAY = 10
+TASK_TIMEOUT = 300
+
+# Cache the rendered project panels of the index page: 'memory' for an LRU of FRAGMENT_CACHE_SIZE panels per process,
+# 'uwsgi' for the uWSGI cache named FRAGMENT_CACHE_UWSGI_NAME shared by all workers, or None to disable
+FRAGMENT_CACHE = 'memory'
+FRAGMENT_CACHE_SIZE = 1000
+FRAGMENT_CACHE_TTL = 86400
+FRAGMENT_CACHE_UWSGI_NAME = 'fragments'
+
+# Title of the site wide Atom feed, the number of posts in each feed, and how many rendered feeds are cached per process
+# and for how many seconds; other processes serve an outdated feed for at most FEED_CACHE_TTL seconds after a change
+FEED_TITLE = 'projects.campen.co'
+FEED_ITEMS = 20
+FEED_CACHE_SIZE = 256
+FEED_CACHE_TTL = 300
+
+# Page size of the API change feed, and the largest page it allows. Changes from the last CHANGES_DELAY seconds are
+# held back so slow transactions are not skipped. Records of deletions are purged by scripts/purge_deleted.py after
+# CHANGES_RETENTION_DAYS, and older cursors are refused
+CHANGES_PER_PAGE = 100
+MAX_CHANGES_PER_PAGE = 1000
+CHANGES_DELAY = 5
+CHANGES_RETENTION_DAYS = 30
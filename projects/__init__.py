@@ -1,16 +1,43 @@
 from flask import Flask
 from flask_login import LoginManager
-from flask_sqlalchemy import SQLAlchemy
 
+from projects.replicas import RoutingSQLAlchemy
 
-app = Flask(__name__)
-app.config.from_object('config')
-db = SQLAlchemy(app)
+
+db = RoutingSQLAlchemy()
 
 login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = "login"
+login_manager.login_view = "web.login"
+
+
+def create_app(config='config'):
+    """Create the application, configured from config (an import path or object, see Flask.config.from_object).
+
+    Route modules are imported here rather than when the package is imported, so scripts that only need the models do
+    not pay for them.
+
+    """
+
+    app = Flask(__name__)
+    app.config.from_object(config)
+
+    db.init_app(app)
+    login_manager.init_app(app)
+
+    from projects import views, api, auth, metrics, compression, feeds, fragments, helpers, search, tasks
+
+    app.register_blueprint(views.blueprint)
+    app.register_blueprint(api.blueprint, url_prefix='/api')
+    app.register_blueprint(metrics.blueprint)
+    app.register_blueprint(feeds.blueprint)
+    auth.init_app(app)
+    compression.init_app(app)
+    feeds.init_app(app)
+    fragments.init_app(app)
+    search.init_app(app)
+    tasks.init_app(app)
 
-from projects import views, models, forms, helpers, api
+    app.jinja_env.filters['markdown_filter'] = helpers.format_markdown
+    app.jinja_env.filters['body_filter'] = helpers.format_body
 
-app.jinja_env.filters['markdown_filter'] = helpers.format_markdown
+    return app
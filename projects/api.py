@@ -1,16 +1,16 @@
-from flask import abort, jsonify, request, url_for
-from flask_login import current_user
-from sqlalchemy import desc
-
-from projects import app
-from projects.models import Project
-
+import datetime
+from collections import OrderedDict
 
-# @app.login_manager.user_loader
-# def load_user(user_id):
-#     return User.query.get(int(user_id))
+from flask import Blueprint, Response, abort, current_app, jsonify, request, stream_with_context, url_for
+from flask_login import current_user
+from werkzeug.urls import url_encode
 
-# TODO: implement token based API authorization
+from projects import changes, db, search
+from projects.auth import api_login_required
+from projects.export import export_records
+from projects.helpers import conditional, decode_cursor, parse_timestamp
+from projects.models import Project, Post
+from projects.replicas import read_only
 
 """
 
@@ -18,49 +18,193 @@ API Routes
 ========================
 
     API only has read access to data (no ability to add or modify projects/posts).
+
+    Requests are authenticated either by the session cookie of a logged in user, or with an API token sent as an
+    `Authorization: Bearer <token>` header (see projects.auth). Unauthenticated requests get a 401.
     
     Endpoints:
-      - /api/projects  :  return all pages(TODO add pagination here)
+      - /api/projects  :  return a page of projects, newest first
       - /api/project/<project_name>  :  return specific project
+      - /api/search  :  return a page of projects and posts matching the query `q`, best match first
+      - /api/export  :  stream all projects and posts as newline delimited JSON, optionally only those created or
+                        edited `since` an ISO 8601 timestamp
+      - /api/changes  :  return a page of the projects and posts created, edited or deleted `since` a cursor from a
+                         previous page (or an ISO 8601 timestamp), oldest first
+
+    /api/projects accepts an optional `limit` (default PROJECTS_PER_PAGE, at most MAX_PROJECTS_PER_PAGE) and `cursor`.
+    The response includes a `next` cursor to pass back as `cursor` to get the following page, which is null on the last
+    page.
+
+    /api/changes accepts an optional `limit` (default CHANGES_PER_PAGE, at most MAX_CHANGES_PER_PAGE). Each change has
+    an `action` of 'upsert', with the current fields of the project or post, or 'delete', which is also sent for
+    content that was made private. The response includes a `next` cursor to pass back as `since`, which is returned
+    even on the last page so it can be polled, and whether there are `more` changes right away. Cursors older than
+    CHANGES_RETENTION_DAYS get a 410, as the records of deletions that old are purged; clients must then sync again
+    from scratch.
       
+    Project responses accept an optional `fields` parameter, a comma separated list of the project fields to return
+    (name, title, body, created, edited, uri), and /api/project and /api/post accept `post_fields` for the fields of
+    the post (post_id, body, created, edited). All fields are returned by default, and timestamps are ISO 8601 strings.
+
     A successful request will result in a JSON response object containing the requested data in `data`. Any attempt to 
     access a project or post that does not exist, or is private, will return a 404 instead of a JSON response, and a bad
     request will return a 400.
 
+    Responses carry ETag and Last-Modified headers, and requests with a matching If-None-Match or If-Modified-Since
+    header get an empty 304 response instead.
+
 """
 
-PROJECT_KEY_FILTER = ['name', 'title', 'body', 'created', 'edited']
-POST_KEY_FILTER = ['post_id', 'body', 'created', 'edited']
+
+def _iso(value):
+    return value.isoformat() if value is not None else None
+
+
+# fields the API returns, with the column each is read from and the function converting it for JSON (None if the value
+# can be used as is). Only the requested columns are selected, as plain rows, so no ORM instances are built.
+PROJECT_FIELDS = OrderedDict([
+    ('name', (Project.name, None)),
+    ('title', (Project.title, None)),
+    ('body', (Project.body, None)),
+    ('created', (Project.created, _iso)),
+    ('edited', (Project.edited, _iso)),
+])
+POST_FIELDS = OrderedDict([
+    ('post_id', (Post.post_id, None)),
+    ('body', (Post.body, None)),
+    ('created', (Post.created, _iso)),
+    ('edited', (Post.edited, _iso)),
+])
+
+# fields of projects that are not columns
+PROJECT_VIRTUAL_FIELDS = ('uri',)
+
+# columns every project query selects ahead of the requested fields, for building uris and looking up posts
+PROJECT_REF_COLUMNS = (Project.id.label('ref_id'), Project.name.label('ref_name'))
+
+
+class FieldPlan(object):
+    """The columns to select for a set of fields, and how to turn the selected rows into dicts.
+
+    Plans are built once per distinct set of requested fields and reused, see get_plan.
+
+    """
+
+    __slots__ = ('keys', 'columns', 'converters', 'offset')
+
+    def __init__(self, fields, keys, ref_columns=()):
+        self.keys = keys
+        self.offset = len(ref_columns)
+        column_keys = [key for key in keys if key in fields]
+        self.columns = list(ref_columns) + [fields[key][0].label(key) for key in column_keys]
+        self.converters = [(key, index, fields[key][1]) for index, key in enumerate(column_keys, self.offset)]
+
+    def serialize(self, row):
+        return {key: convert(row[index]) if convert is not None else row[index]
+                for key, index, convert in self.converters}
+
+
+_plans = {}
+
+
+def parse_plan(fields, param, requested, virtual_fields=(), ref_columns=()):
+    """Return the FieldPlan for requested, the comma separated value of the argument param, or all fields if None.
+
+    Raises ValueError if an unknown field is requested.
+
+    """
+
+    if requested is None:
+        keys = tuple(fields) + tuple(virtual_fields)
+    else:
+        requested = set(key.strip() for key in requested.split(','))
+        if not requested or not requested <= set(fields) | set(virtual_fields):
+            raise ValueError('Unknown field requested in %s' % param)
+        # keep the declared order, so each distinct set of fields has a single plan
+        keys = tuple(key for key in tuple(fields) + tuple(virtual_fields) if key in requested)
+
+    plan_key = (param, keys)
+    plan = _plans.get(plan_key)
+    if plan is None:
+        plan = _plans[plan_key] = FieldPlan(fields, keys, ref_columns)
+
+    return plan
+
+
+def get_plan(fields, param, virtual_fields=(), ref_columns=()):
+    """Return the FieldPlan for the fields listed in the request argument param, aborting with a 400 if invalid."""
+
+    try:
+        return parse_plan(fields, param, request.args.get(param), virtual_fields, ref_columns)
+    except ValueError:
+        abort(400)
+
+
+def project_plan():
+    return get_plan(PROJECT_FIELDS, 'fields', PROJECT_VIRTUAL_FIELDS, PROJECT_REF_COLUMNS)
+
+
+def post_plan():
+    return get_plan(POST_FIELDS, 'post_fields')
+
+
+def project_list_version():
+    """Version of the non-private projects listing, for conditional requests."""
+    return Project.get_list_version(current_user.id, include_private=False)
+
+
+def project_version():
+    """Version of the requested project and its posts, for conditional requests."""
+
+    project_name = request.args.get('name')
+    if project_name is None:
+        return None
+
+    return Project.get_version(current_user.id, project_name)
 
 # ---------------- API routes ---------------- #
 
 
-@app.route('/api/projects', methods=['GET'])
+blueprint = Blueprint('api', __name__)
+
+
+@blueprint.route('/projects', methods=['GET'])
+@read_only
+@api_login_required
+@conditional(project_list_version)
 def get_projects():
-    """Returns all projects."""
+    """Returns a page of non-private projects."""
 
-    # None if no pages exist
-    projects = Project.query.filter_by(user_id=current_user.id).order_by(desc(Project.created)).all()
+    default_limit = current_app.config.get('PROJECTS_PER_PAGE', 20)
+    max_limit = current_app.config.get('MAX_PROJECTS_PER_PAGE', 100)
 
-    # init response data container
-    formatted_projects_data = []
+    try:
+        limit = int(request.args.get('limit', default_limit))
+    except ValueError:
+        # limit is not an integer so we abort with bad request response
+        abort(400)
 
-    if projects is None:
-        # if project is None then the project doesn't exist so we abort
-        abort(404)
+    if not 1 <= limit <= max_limit:
+        abort(400)
+
+    plan = project_plan()
 
-    # go through projects, filtering to only the fields we want returned, and only if page is not private.
-    for project in projects:
-        if not project.private:
+    try:
+        projects, next_cursor = Project.get_page(current_user.id, cursor=request.args.get('cursor'), limit=limit,
+                                                 include_private=False, columns=plan.columns)
+    except ValueError:
+        # cursor was not one we issued
+        abort(400)
 
-            # filter project data sent in response
-            formatted_project_data = format_project_data(project)
-            formatted_projects_data.append(formatted_project_data)
+    formatted_projects_data = format_projects_data(plan, projects)
 
-    return jsonify({'data': formatted_projects_data})
+    return jsonify({'data': formatted_projects_data, 'next': next_cursor})
 
 
-@app.route('/api/project', methods=['GET'])
+@blueprint.route('/project', methods=['GET'])
+@read_only
+@api_login_required
+@conditional(project_version)
 def get_project():
     """Returns a single project."""
 
@@ -71,31 +215,27 @@ def get_project():
         # no project_name specified so we abort with bad request response
         abort(400)
 
-    # None if no page with page_name exists
-    project = Project.query.filter_by(user_id=current_user.id, name=project_name).first()
-    if project is not None:
-        if project.private:
-            # treat private projects as not existing
-            project = None
+    plan, post_fields_plan = project_plan(), post_plan()
 
-    # return not found error if project does not exist or is private
+    # treat private projects as not existing, returning not found error
+    project = get_project_row(plan, project_name)
     if project is None:
         abort(404)
 
-    # get list of non-private posts for the project
-    posts = [post for post in project.posts if not post.private]
+    # get most recent non-private post by default
+    post = db.session.query(*post_fields_plan.columns).filter(
+        Post.project_id == project.ref_id, Post.private == False).order_by(Post.post_id.desc()).first()
 
-    formatted_project_data = format_project_data(project)
-    if len(posts) >= 1:
-        # get most recent post by default
-        formatted_project_data['post'] = format_post_data(posts[-1])
-    else:
-        formatted_project_data['post'] = None
+    formatted_project_data = format_projects_data(plan, [project])[0]
+    formatted_project_data['post'] = post_fields_plan.serialize(post) if post is not None else None
 
     return jsonify({'data': formatted_project_data})
 
 
-@app.route('/api/post', methods=['GET'])
+@blueprint.route('/post', methods=['GET'])
+@read_only
+@api_login_required
+@conditional(project_version)
 def get_post():
     """Returns a specified post."""
 
@@ -107,46 +247,155 @@ def get_post():
         # no project_name or post_id specified so we abort with bad request response
         abort(400)
 
-    # None if no page with page_name exists
-    project = Project.query.filter_by(user_id=current_user.id, name=project_name).first()
-    if project is not None:
-        if project.private:
-            # treat private projects as not existing
-            project = None
+    try:
+        post_id = int(post_id)
+    except ValueError:
+        # post_id is not an integer so we abort with bad request response
+        abort(400)
+
+    plan, post_fields_plan = project_plan(), post_plan()
 
-    # return not found error if project does not exist or is private
+    # treat private projects as not existing, returning not found error
+    project = get_project_row(plan, project_name)
     if project is None:
         abort(404)
 
-    post = project.posts.filter_by(id=post_id).first()
-    if post is not None:
-        if post.private:
-            # treat private posts as not existing
-            post = None
-
-    # return not found error if post does not exist or is private
+    # treat private posts as not existing, returning not found error
+    post = db.session.query(*post_fields_plan.columns).filter(
+        Post.project_id == project.ref_id, Post.post_id == post_id, Post.private == False).first()
     if post is None:
         abort(404)
 
-    formatted_page_data = format_project_data(project)
-    formatted_page_data['post'] = format_post_data(post)
+    formatted_page_data = format_projects_data(plan, [project])[0]
+    formatted_page_data['post'] = post_fields_plan.serialize(post)
 
     return jsonify({'data': formatted_page_data})
 
 
+@blueprint.route('/search', methods=['GET'])
+@read_only
+@api_login_required
+def search_projects():
+    """Returns a page of non-private projects and posts matching a search query."""
+
+    query = request.args.get('q')
+
+    if query is None:
+        # no query specified so we abort with bad request response
+        abort(400)
+
+    try:
+        limit = int(request.args.get('limit', current_app.config.get('SEARCH_RESULTS_PER_PAGE', 20)))
+        page = int(request.args.get('page', 1))
+    except ValueError:
+        abort(400)
+
+    if not 1 <= limit <= current_app.config.get('MAX_PROJECTS_PER_PAGE', 100) or page < 1:
+        abort(400)
+
+    offset = (page - 1) * limit
+    if offset >= current_app.config.get('SEARCH_MAX_RESULTS', 1000):
+        # deep pages of ranked results are expensive and not useful, so they are not served
+        abort(404)
+
+    # fetch one extra result to find out whether there is a following page
+    results = search.search(current_user.id, query, limit=limit + 1, offset=offset, include_private=False)
+    if results is None:
+        # search is not available for the configured database
+        abort(404)
+
+    formatted_results = []
+    for result in results[:limit]:
+        formatted_result = dict(result, snippet=str(result['snippet']))
+        formatted_result['uri'] = url_for('.get_project', name=result['name'])
+        formatted_results.append(formatted_result)
+
+    return jsonify({'data': formatted_results, 'next': page + 1 if len(results) > limit else None})
+
+
+@blueprint.route('/changes', methods=['GET'])
+@api_login_required
+def get_changes():
+    """Returns a page of changes to non-private projects and posts.
+
+    Not served from replicas: a replica lagging behind could hide changes older than the position a client moves to.
+
+    """
+
+    try:
+        limit = int(request.args.get('limit', current_app.config.get('CHANGES_PER_PAGE', 100)))
+    except ValueError:
+        abort(400)
+
+    if not 1 <= limit <= current_app.config.get('MAX_CHANGES_PER_PAGE', 1000):
+        abort(400)
+
+    since = request.args.get('since')
+    position = None
+    if since is not None:
+        try:
+            position = decode_cursor(since)
+            if len(position) != 3:
+                raise ValueError('Not a change feed cursor')
+        except ValueError:
+            try:
+                # every change at or after the timestamp
+                position = (parse_timestamp(since), -1, 0)
+            except ValueError:
+                abort(400)
+
+        retention = datetime.timedelta(days=current_app.config.get('CHANGES_RETENTION_DAYS', 30))
+        if position[0] < datetime.datetime.now() - retention:
+            # tombstones of deletions since then may have been purged
+            abort(410)
+
+    page, more = changes.get_changes(current_user.id, position, limit=limit,
+                                     delay=current_app.config.get('CHANGES_DELAY', 5))
+
+    next_cursor = changes.encode_position(page[-1][0]) if page else since
+
+    return jsonify({'data': [record for _, record in page], 'next': next_cursor, 'more': more})
+
+
+@blueprint.route('/export', methods=['GET'])
+@read_only
+@api_login_required
+def export_projects():
+    """Streams all non-private projects and posts as newline delimited JSON."""
+
+    since = request.args.get('since')
+    if since is not None:
+        try:
+            since = parse_timestamp(since)
+        except ValueError:
+            abort(400)
+
+    records = export_records(user_id=current_user.id, since=since, include_private=False,
+                             batch_size=current_app.config.get('EXPORT_BATCH_SIZE', 1000))
+
+    return Response(stream_with_context(records), mimetype='application/x-ndjson')
+
+
 # ---------------- helper functions ---------------- #
 
 
-def format_project_data(project_data):
-    """Filter our fields from project_data that aren't in PROJECT_KEY_FILTER."""
+def get_project_row(plan, project_name):
+    """Return the row of plan columns of a non-private project of the current user, or None."""
 
-    formatted_data = {key: value for key, value in vars(project_data).items() if key in PROJECT_KEY_FILTER}
-    formatted_data['uri'] = url_for('get_project', name=project_data.name)
+    return db.session.query(*plan.columns).filter(
+        Project.user_id == current_user.id, Project.name == project_name, Project.deleted == None,
+        Project.private == False).first()
 
-    return formatted_data
 
+def format_projects_data(plan, rows):
+    """Serialize project rows selected with plan, adding their uri if it was requested."""
 
-def format_post_data(post_data):
-    """Filter out fields from post_data that aren't in POST_KEY_FILTER."""
+    formatted_data = [plan.serialize(row) for row in rows]
 
-    return {key: value for key, value in vars(post_data).items() if key in POST_KEY_FILTER}
+    if 'uri' in plan.keys:
+        # build the uri of the project endpoint once, rather than once per project
+        base_uri = url_for('.get_project')
+        for data, row in zip(formatted_data, rows):
+            data['uri'] = '%s?%s' % (base_uri, url_encode({'name': row.ref_name}))
+
+    return formatted_data
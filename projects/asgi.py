@@ -0,0 +1,482 @@
+import asyncio
+import hmac
+import json
+import os
+
+from itsdangerous import BadSignature
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.orm import Query
+from werkzeug.http import http_date, parse_cookie, parse_date, parse_etags, quote_etag
+from werkzeug.urls import url_decode, url_encode
+
+from projects import create_app
+from projects.api import PROJECT_FIELDS, PROJECT_REF_COLUMNS, PROJECT_VIRTUAL_FIELDS, POST_FIELDS, parse_plan
+from projects.auth import SessionUser, TokenUser, hash_secret, parse_session_id
+from projects.helpers import TTLCache, encode_cursor, make_etag
+from projects.models import Project, Post, User, list_version, list_version_query, project_page_query, \
+    project_version, project_version_query
+
+
+"""
+
+Async read-only API
+========================
+
+    An ASGI application serving the read-only API routes /api/projects, /api/project and /api/post with the same
+    parameters and JSON responses as the Flask routes in projects.api, for clients such as pollers that hold many
+    mostly idle connections. Run it with any ASGI server from the asgi.py entry point next to run.py, e.g.
+
+        uvicorn asgi:app
+
+    Requests are handled on a single event loop rather than a thread each, and queries run on an async driver with a
+    pool of ASYNC_API_POOL_SIZE connections to ASYNC_API_DATABASE_URI (SQLALCHEMY_DATABASE_URI by default, but it can
+    be a replica): asyncpg for PostgreSQL and aiosqlite for SQLite, which are only needed by this server. Listings and
+    versions come from the same query builders as the Flask routes (see the shared queries in projects.models), other
+    queries from the same models and field plans, and all are compiled for the driver by SQLAlchemy.
+
+    Requests authenticate with the same API tokens and login session cookies as the Flask application, and get the
+    same ETags, so a client can switch between the two without downloading unchanged content again. Responses are
+    not compressed; put the server behind a proxy that does that if needed.
+
+"""
+
+
+class HTTPError(Exception):
+    """Raised by route handlers to respond with an error status."""
+
+    def __init__(self, status):
+        super(HTTPError, self).__init__(status)
+        self.status = status
+
+
+class Database(object):
+    """Base of the async connection pools, compiling queries for their driver and converting values like SQLAlchemy."""
+
+    def __init__(self, dialect, pool_size):
+        self.dialect = dialect
+        self.pool_size = pool_size
+
+    def compile(self, query):
+        """Return the sql of a sessionless Query, its positional parameters, and result processors of its columns."""
+
+        compiled = query.statement.compile(dialect=self.dialect)
+        params = compiled.construct_params()
+
+        values = []
+        for name in compiled.positiontup:
+            processor = compiled.binds[name].type.dialect_impl(self.dialect).bind_processor(self.dialect)
+            values.append(processor(params[name]) if processor is not None else params[name])
+
+        processors = [description['type'].dialect_impl(self.dialect).result_processor(self.dialect, None)
+                      for description in query.column_descriptions]
+
+        return compiled.string, values, processors
+
+    async def fetch_all(self, query):
+        sql, values, processors = self.compile(query)
+        rows = await self.execute(sql, values)
+
+        return [tuple(processor(value) if processor is not None else value
+                      for processor, value in zip(processors, row)) for row in rows]
+
+    async def fetch_one(self, query):
+        rows = await self.fetch_all(query.limit(1))
+        return rows[0] if rows else None
+
+
+class PostgresDatabase(Database):
+    """Pool of asyncpg connections."""
+
+    def __init__(self, url, pool_size):
+        from sqlalchemy.dialects import postgresql
+
+        # asyncpg takes $1 style parameters, rendered from SQLAlchemy's :1 style, see execute
+        super(PostgresDatabase, self).__init__(postgresql.dialect(paramstyle='numeric'), pool_size)
+        self.url = url
+        self._pool = None
+
+    async def connect(self):
+        import asyncpg
+
+        self._pool = await asyncpg.create_pool(host=self.url.host, port=self.url.port, user=self.url.username,
+                                               password=self.url.password, database=self.url.database,
+                                               min_size=1, max_size=self.pool_size)
+
+    async def execute(self, sql, values):
+        # the queries never contain literal strings or :: casts, so this only touches parameters
+        for position in range(len(values), 0, -1):
+            sql = sql.replace(':%d' % position, '$%d' % position)
+
+        async with self._pool.acquire() as connection:
+            return await connection.fetch(sql, *values)
+
+    async def close(self):
+        await self._pool.close()
+
+
+class SqliteDatabase(Database):
+    """Pool of aiosqlite connections, e.g. for development."""
+
+    def __init__(self, url, pool_size, root_path):
+        from sqlalchemy.dialects import sqlite
+
+        super(SqliteDatabase, self).__init__(sqlite.dialect(paramstyle='qmark'), pool_size)
+        if url.database in (None, '', ':memory:'):
+            self.path = ':memory:'
+        else:
+            # relative to the application root, as Flask-SQLAlchemy resolves them
+            self.path = os.path.join(root_path, url.database)
+        self._connections = None
+
+    async def connect(self):
+        import aiosqlite
+
+        self._connections = asyncio.Queue()
+        for _ in range(self.pool_size):
+            self._connections.put_nowait(await aiosqlite.connect(self.path))
+
+    async def execute(self, sql, values):
+        connection = await self._connections.get()
+        try:
+            async with connection.execute(sql, values) as cursor:
+                return await cursor.fetchall()
+        finally:
+            self._connections.put_nowait(connection)
+
+    async def close(self):
+        while not self._connections.empty():
+            await self._connections.get_nowait().close()
+
+
+def create_database(uri, pool_size, root_path):
+    url = make_url(uri)
+    backend = url.drivername.split('+')[0]
+
+    if backend == 'postgresql':
+        return PostgresDatabase(url, pool_size)
+    elif backend == 'sqlite':
+        return SqliteDatabase(url, pool_size, root_path)
+
+    raise ValueError('The async API does not support %s databases' % backend)
+
+
+class Request(object):
+    """The parts of an ASGI http request the routes need."""
+
+    def __init__(self, scope):
+        self.method = scope['method']
+        self.root_path = scope.get('root_path', '')
+        self.path = scope['path']
+        self.query_string = scope.get('query_string', b'').decode('latin-1')
+        self.args = url_decode(self.query_string)
+        self.headers = {name.decode('latin-1').lower(): value.decode('latin-1') for name, value in scope['headers']}
+        self.user = None
+
+    @property
+    def full_path(self):
+        # as werkzeug's Request.full_path, so ETags match those of the Flask routes
+        return '%s?%s' % (self.path, self.query_string)
+
+
+class AsyncAPI(object):
+    """ASGI application serving the read-only API routes."""
+
+    def __init__(self, app):
+        self.config = app.config
+        self.database = create_database(app.config.get('ASYNC_API_DATABASE_URI') or
+                                        app.config['SQLALCHEMY_DATABASE_URI'],
+                                        app.config.get('ASYNC_API_POOL_SIZE', 20), app.root_path)
+
+        self.session_cookie_name = app.session_cookie_name
+        self.session_serializer = app.session_interface.get_signing_serializer(app)
+        self.session_max_age = app.permanent_session_lifetime.total_seconds()
+
+        self.token_cache = TTLCache(max_size=app.config.get('API_TOKEN_CACHE_SIZE', 1024),
+                                    ttl=app.config.get('API_TOKEN_CACHE_TTL', 60))
+        self.session_cache = TTLCache(max_size=app.config.get('SESSION_USER_CACHE_SIZE', 1024),
+                                      ttl=app.config.get('SESSION_USER_CACHE_TTL', 60))
+
+        self.routes = {
+            '/api/projects': self.get_projects,
+            '/api/project': self.get_project,
+            '/api/post': self.get_post,
+        }
+
+        self._connected = False
+        self._connect_lock = None
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self.lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self.handle(Request(scope), send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                try:
+                    await self.connect()
+                except Exception as e:
+                    print('[ERROR]: ', e)
+                    # the server exits rather than serving requests that would all fail
+                    await send({'type': 'lifespan.startup.failed', 'message': str(e)})
+                    return
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self._connected:
+                    await self.database.close()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def connect(self):
+        # servers that do not send lifespan events connect on the first request
+        if self._connect_lock is None:
+            self._connect_lock = asyncio.Lock()
+
+        async with self._connect_lock:
+            if not self._connected:
+                await self.database.connect()
+                self._connected = True
+
+    async def handle(self, request, send):
+        route = self.routes.get(request.path)
+
+        try:
+            if route is None:
+                raise HTTPError(404)
+            if request.method not in ('GET', 'HEAD'):
+                raise HTTPError(405)
+
+            if not self._connected:
+                await self.connect()
+
+            request.user = await self.authenticate(request)
+            if request.user is None:
+                raise HTTPError(401)
+
+            status, data, headers = await route(request)
+        except HTTPError as e:
+            status, data, headers = e.status, None, []
+        except Exception as e:
+            print('[ERROR]: ', e)
+            status, data, headers = 500, None, []
+
+        if data is not None:
+            body = json.dumps(data, sort_keys=True).encode('utf-8')
+            headers.append(('Content-Type', 'application/json'))
+        else:
+            body = b''
+        headers.append(('Content-Length', str(len(body))))
+
+        await send({'type': 'http.response.start', 'status': status,
+                    'headers': [(name.encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+        await send({'type': 'http.response.body', 'body': body if request.method != 'HEAD' else b''})
+
+    # ---------------- authentication ---------------- #
+
+    async def authenticate(self, request):
+        """Return the TokenUser or SessionUser the request is authenticated as, or None, as projects.auth does."""
+
+        authorization = request.headers.get('authorization', '')
+        if authorization.startswith('Bearer '):
+            return await self.verify_api_token(authorization[len('Bearer '):].strip())
+
+        cookie = parse_cookie(request.headers.get('cookie', '')).get(self.session_cookie_name)
+        if cookie is None:
+            return None
+
+        try:
+            session = self.session_serializer.loads(cookie, max_age=self.session_max_age)
+            # newer Flask-Login versions store the id under _user_id
+            user_id, session_version = parse_session_id(session.get('_user_id') or session.get('user_id') or '')
+        except (BadSignature, ValueError):
+            return None
+
+        cached = self.session_cache.get(user_id)
+        if cached is None or cached[1] < session_version:
+            cached = await self.database.fetch_one(
+                Query([User.username, User.session_version]).filter(User.id == user_id))
+            if cached is None:
+                return None
+            self.session_cache.set(user_id, cached)
+
+        username, current_version = cached
+        if session_version != current_version:
+            return None
+
+        return SessionUser(user_id, username, session_version)
+
+    async def verify_api_token(self, token):
+        cache_key = hash_secret(token)
+        cached = self.token_cache.get(cache_key)
+        if cached is not None:
+            return TokenUser(*cached)
+
+        token_id, _, secret = token.partition('.')
+        if not token_id or not secret:
+            return None
+
+        user = await self.database.fetch_one(
+            Query([User.id, User.username, User.api_token_digest]).filter(User.api_token_id == token_id))
+        if user is None or user[2] is None:
+            return None
+
+        if not hmac.compare_digest(user[2], hash_secret(secret)):
+            return None
+
+        self.token_cache.set(cache_key, (user[0], user[1]))
+
+        return TokenUser(user[0], user[1])
+
+    # ---------------- routes ---------------- #
+
+    def conditional(self, request, parts, last_modified):
+        """Return the ETag and Last-Modified headers of a version, and whether the client already has it."""
+
+        etag = make_etag(self.config.get('CACHE_VERSION'), request.user.get_id(), request.full_path, parts)
+
+        # weak like the ETags of the Flask routes, which are shared by compressed and uncompressed responses
+        headers = [('ETag', quote_etag(etag, weak=True)), ('Cache-Control', 'private, no-cache')]
+        if last_modified is not None:
+            headers.append(('Last-Modified', http_date(last_modified)))
+
+        if 'if-none-match' in request.headers:
+            fresh = parse_etags(request.headers['if-none-match']).contains_weak(etag)
+        else:
+            since = parse_date(request.headers.get('if-modified-since'))
+            fresh = since is not None and last_modified is not None and \
+                last_modified.replace(microsecond=0) <= since.replace(tzinfo=None)
+
+        return headers, fresh
+
+    def plans(self, request):
+        try:
+            return (parse_plan(PROJECT_FIELDS, 'fields', request.args.get('fields'), PROJECT_VIRTUAL_FIELDS,
+                               PROJECT_REF_COLUMNS),
+                    parse_plan(POST_FIELDS, 'post_fields', request.args.get('post_fields')))
+        except ValueError:
+            raise HTTPError(400)
+
+    def format_projects_data(self, request, plan, rows):
+        formatted_data = [plan.serialize(row) for row in rows]
+
+        if 'uri' in plan.keys:
+            base_uri = request.root_path + '/api/project'
+            for data, row in zip(formatted_data, rows):
+                # the name is the second of the PROJECT_REF_COLUMNS
+                data['uri'] = '%s?%s' % (base_uri, url_encode({'name': row[1]}))
+
+        return formatted_data
+
+    async def get_projects(self, request):
+        """Returns a page of non-private projects, as api.get_projects."""
+
+        try:
+            limit = int(request.args.get('limit', self.config.get('PROJECTS_PER_PAGE', 20)))
+        except ValueError:
+            raise HTTPError(400)
+
+        if not 1 <= limit <= self.config.get('MAX_PROJECTS_PER_PAGE', 100):
+            raise HTTPError(400)
+
+        plan = self.plans(request)[0]
+
+        parts, last_modified = list_version(await self.database.fetch_one(
+            list_version_query(request.user.id, include_private=False)))
+        headers, fresh = self.conditional(request, parts, last_modified)
+        if fresh:
+            return 304, None, headers
+
+        try:
+            query = project_page_query(request.user.id, cursor=request.args.get('cursor'), limit=limit,
+                                       include_private=False, columns=plan.columns)
+        except ValueError:
+            raise HTTPError(400)
+
+        projects = await self.database.fetch_all(query)
+
+        next_cursor = None
+        if len(projects) > limit:
+            projects = projects[:limit]
+            next_cursor = encode_cursor(projects[-1][-2], projects[-1][-1])
+
+        return 200, {'data': self.format_projects_data(request, plan, projects), 'next': next_cursor}, headers
+
+    async def project_version(self, request, project_name):
+        version = project_version(await self.database.fetch_one(
+            project_version_query(request.user.id, project_name)))
+        if version is None:
+            return [], False
+
+        return self.conditional(request, *version)
+
+    async def get_project_row(self, request, plan, project_name):
+        return await self.database.fetch_one(Query(plan.columns).filter(
+            Project.user_id == request.user.id, Project.name == project_name, Project.deleted == None,
+            Project.private == False))
+
+    async def get_project(self, request):
+        """Returns a single project, as api.get_project."""
+
+        project_name = request.args.get('name')
+        if project_name is None:
+            raise HTTPError(400)
+
+        plan, post_fields_plan = self.plans(request)
+
+        headers, fresh = await self.project_version(request, project_name)
+        if fresh:
+            return 304, None, headers
+
+        project = await self.get_project_row(request, plan, project_name)
+        if project is None:
+            raise HTTPError(404)
+
+        # the ref_id is the first of the PROJECT_REF_COLUMNS
+        post = await self.database.fetch_one(Query(post_fields_plan.columns).filter(
+            Post.project_id == project[0], Post.private == False).order_by(Post.post_id.desc()))
+
+        data = self.format_projects_data(request, plan, [project])[0]
+        data['post'] = post_fields_plan.serialize(post) if post is not None else None
+
+        return 200, {'data': data}, headers
+
+    async def get_post(self, request):
+        """Returns a specified post, as api.get_post."""
+
+        project_name = request.args.get('name')
+        post_id = request.args.get('id')
+        if project_name is None or post_id is None:
+            raise HTTPError(400)
+
+        try:
+            post_id = int(post_id)
+        except ValueError:
+            raise HTTPError(400)
+
+        plan, post_fields_plan = self.plans(request)
+
+        headers, fresh = await self.project_version(request, project_name)
+        if fresh:
+            return 304, None, headers
+
+        project = await self.get_project_row(request, plan, project_name)
+        if project is None:
+            raise HTTPError(404)
+
+        post = await self.database.fetch_one(Query(post_fields_plan.columns).filter(
+            Post.project_id == project[0], Post.post_id == post_id, Post.private == False))
+        if post is None:
+            raise HTTPError(404)
+
+        data = self.format_projects_data(request, plan, [project])[0]
+        data['post'] = post_fields_plan.serialize(post)
+
+        return 200, {'data': data}, headers
+
+
+def create_asgi_app(config='config'):
+    """Create the async API application, configured like create_app."""
+
+    return AsyncAPI(create_app(config))
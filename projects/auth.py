@@ -0,0 +1,293 @@
+import base64
+import hashlib
+import hmac
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+from functools import wraps
+
+from flask import abort, current_app
+from flask_login import current_user
+from sqlalchemy_utils.types.password import Password
+
+from projects import db, login_manager
+from projects.helpers import TokenBuckets, TTLCache
+from projects.models import User
+
+
+"""
+
+API token authentication
+========================
+
+    API requests can authenticate with an `Authorization: Bearer <token>` header instead of a session cookie. A token
+    has the form `<token id>.<secret>`. The token id is stored in an indexed column so the user can be found with a
+    single lookup, and only a SHA-256 digest of the secret is stored. Secrets are 256 bit random values, so a fast
+    digest is as safe as a slow password hash here, and checking one costs microseconds rather than the tens of
+    milliseconds of pbkdf2.
+
+    Verified tokens are kept in a bounded in-process cache for API_TOKEN_CACHE_TTL seconds, so a revoked token may
+    keep working for up to that long in processes that had already verified it.
+
+    Tokens are issued, rotated and revoked with scripts/api_token.py.
+
+Session users
+========================
+
+    Login sessions store the user id together with the users session version, e.g. `'1:0'`. The id, username and
+    current session version of users are kept in a bounded in-process cache for SESSION_USER_CACHE_TTL seconds, so
+    requests of logged in users are authenticated without loading the user, and never load its password hash. Session
+    versions only increase, so a session with an older version than the cached one has ended, and the user is only
+    loaded again when a session has a newer version, e.g. after logging in on another process.
+
+    `end_sessions` increments the version, logging the user out everywhere. Other processes that had cached the old
+    version keep accepting its sessions for up to SESSION_USER_CACHE_TTL seconds.
+
+Password logins
+========================
+
+    Checking a pbkdf2 password hash takes tens of milliseconds of CPU, so login attempts are limited before any
+    hashing is done:
+
+      - each client IP and each username has a token bucket, refilled with LOGIN_IP_ATTEMPTS_PER_MINUTE and
+        LOGIN_USERNAME_ATTEMPTS_PER_MINUTE attempts a minute, holding up to LOGIN_IP_BURST and LOGIN_USERNAME_BURST
+      - hashes are checked by a pool of PASSWORD_WORKERS threads, with at most PASSWORD_QUEUE_SIZE checks running or
+        waiting, so a burst of logins can not take all the CPU from page requests
+
+    Attempts over either limit are rejected with a 429. The limits are per process.
+
+    Hashes use PASSWORD_ROUNDS pbkdf2 rounds when set. A hash with a different number of rounds is replaced the next
+    time its user logs in.
+
+"""
+
+_token_cache = TTLCache()
+_session_cache = TTLCache()
+
+_ip_buckets = TokenBuckets()
+_username_buckets = TokenBuckets()
+_password_executor = None
+_password_slots = None
+
+
+def init_app(app):
+    global _password_executor, _password_slots
+
+    _token_cache.max_size = app.config.get('API_TOKEN_CACHE_SIZE', 1024)
+    _token_cache.ttl = app.config.get('API_TOKEN_CACHE_TTL', 60)
+    _session_cache.max_size = app.config.get('SESSION_USER_CACHE_SIZE', 1024)
+    _session_cache.ttl = app.config.get('SESSION_USER_CACHE_TTL', 60)
+
+    _ip_buckets.rate = app.config.get('LOGIN_IP_ATTEMPTS_PER_MINUTE', 20) / 60.0
+    _ip_buckets.burst = app.config.get('LOGIN_IP_BURST', 20)
+    _username_buckets.rate = app.config.get('LOGIN_USERNAME_ATTEMPTS_PER_MINUTE', 5) / 60.0
+    _username_buckets.burst = app.config.get('LOGIN_USERNAME_BURST', 10)
+
+    # threads are only started on the first submit, so this is safe to create before uWSGI forks its workers
+    _password_executor = ThreadPoolExecutor(max_workers=app.config.get('PASSWORD_WORKERS', 2))
+    _password_slots = threading.BoundedSemaphore(app.config.get('PASSWORD_QUEUE_SIZE', 8))
+
+    rounds = app.config.get('PASSWORD_ROUNDS')
+    if rounds:
+        # hashes with more or fewer rounds need an update, see check_password
+        password_context().update(pbkdf2_sha512__default_rounds=rounds, pbkdf2_sha512__min_desired_rounds=rounds,
+                                  pbkdf2_sha512__max_desired_rounds=rounds)
+
+
+class TokenUser(object):
+    """The user an API request was authenticated as by its token.
+
+    Only carries the id and username, so requests with a cached token need no database access to authenticate.
+
+    """
+
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, id, username):
+        self.id = id
+        self.username = username
+
+    def get_id(self):
+        return str(self.id)
+
+    def __repr__(self):
+        return '<TokenUser %r>' % self.username
+
+
+class SessionUser(TokenUser):
+    """The user a request was authenticated as by its login session."""
+
+    def __init__(self, id, username, session_version):
+        super(SessionUser, self).__init__(id, username)
+        self.session_version = session_version
+
+    def get_id(self):
+        return '%d:%d' % (self.id, self.session_version)
+
+    def __repr__(self):
+        return '<SessionUser %r>' % self.username
+
+
+def hash_secret(secret):
+    return hashlib.sha256(secret.encode('utf-8')).hexdigest()
+
+
+def generate_api_token(user):
+    """Issue a new API token for user, replacing any existing token, and return it. Does not commit.
+
+    Only a digest of the token is stored, so it can not be shown again later.
+
+    """
+
+    token_id = base64.b16encode(os.urandom(8)).decode('ascii').lower()
+    secret = base64.urlsafe_b64encode(os.urandom(32)).decode('ascii').rstrip('=')
+
+    user.api_token_id = token_id
+    user.api_token_digest = hash_secret(secret)
+
+    return '%s.%s' % (token_id, secret)
+
+
+def revoke_api_token(user):
+    """Remove the API token of user. Does not commit."""
+
+    user.api_token_id = None
+    user.api_token_digest = None
+
+
+def verify_api_token(token):
+    """Return the TokenUser that token belongs to, or None if it is not a valid token."""
+
+    cache_key = hash_secret(token)
+    cached = _token_cache.get(cache_key)
+    if cached is not None:
+        return TokenUser(*cached)
+
+    token_id, _, secret = token.partition('.')
+    if not token_id or not secret:
+        return None
+
+    user = db.session.query(User.id, User.username, User.api_token_digest).filter_by(api_token_id=token_id).first()
+    if user is None or user.api_token_digest is None:
+        return None
+
+    if not hmac.compare_digest(user.api_token_digest, hash_secret(secret)):
+        return None
+
+    _token_cache.set(cache_key, (user.id, user.username))
+
+    return TokenUser(user.id, user.username)
+
+
+def parse_session_id(session_id):
+    """Return the (user id, session version) of a login session id. Raises ValueError if it is malformed."""
+
+    user_id, _, session_version = session_id.partition(':')
+
+    # sessions from before session versions were added have version 0
+    return int(user_id), int(session_version or 0)
+
+
+@login_manager.user_loader
+def load_user(session_id):
+    """Return the SessionUser of a login session id, or None if the session has ended."""
+
+    try:
+        user_id, session_version = parse_session_id(session_id)
+    except ValueError:
+        return None
+
+    cached = _session_cache.get(user_id)
+    if cached is None or cached[1] < session_version:
+        cached = db.session.query(User.username, User.session_version).filter_by(id=user_id).first()
+        if cached is None:
+            return None
+        _session_cache.set(user_id, tuple(cached))
+
+    username, current_version = cached
+    if session_version != current_version:
+        return None
+
+    return SessionUser(user_id, username, session_version)
+
+
+def end_sessions(user):
+    """Log user out of all their sessions. Does not commit."""
+
+    user.end_sessions()
+    _session_cache.delete(user.id)
+
+
+class LoginThrottled(Exception):
+    """Raised when a login attempt is rejected without checking its password."""
+
+
+def password_context():
+    """The passlib CryptContext that hashes and verifies user passwords."""
+
+    return User.__table__.c.password.type.context
+
+
+def allow_login_attempt(ip, username):
+    """Take a login attempt from the buckets of the client ip and username, returning False if either is empty."""
+
+    return _ip_buckets.take(ip) and _username_buckets.take(username.lower())
+
+
+def check_password(user, password):
+    """Return whether password is the password of user, checked in the password thread pool.
+
+    If the hash of user is outdated, e.g. because PASSWORD_ROUNDS changed, it is replaced with a new one. Does not
+    commit. Raises LoginThrottled if too many checks are already running or waiting.
+
+    """
+
+    if not _password_slots.acquire(False):
+        raise LoginThrottled('Too many password checks in progress')
+
+    try:
+        future = _password_executor.submit(password_context().verify_and_update, password, user.password.hash)
+    except Exception:
+        _password_slots.release()
+        raise
+
+    # a check that timed out keeps its slot until it finishes
+    future.add_done_callback(lambda _: _password_slots.release())
+
+    try:
+        valid, new_hash = future.result(timeout=current_app.config.get('PASSWORD_TIMEOUT', 5))
+    except TimeoutError:
+        raise LoginThrottled('Password check timed out')
+
+    if valid and new_hash is not None:
+        user.password = Password(new_hash, password_context())
+
+    return valid
+
+
+@login_manager.request_loader
+def load_user_from_request(request):
+    """Authenticate API requests that carry a bearer token, when there is no logged in user in the session."""
+
+    if not request.path.startswith('/api/'):
+        return None
+
+    header = request.headers.get('Authorization', '')
+    if not header.startswith('Bearer '):
+        return None
+
+    return verify_api_token(header[len('Bearer '):].strip())
+
+
+def api_login_required(view):
+    """Decorator rejecting unauthenticated API requests with a 401, rather than redirecting them to the login page."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if not current_user.is_authenticated:
+            abort(401)
+        return view(*args, **kwargs)
+
+    return wrapper
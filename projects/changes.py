@@ -0,0 +1,135 @@
+import datetime
+
+from sqlalchemy import and_, or_
+
+from projects import db
+from projects.helpers import encode_cursor
+from projects.models import Project, Post, Tombstone
+
+
+"""
+
+Change feed
+========================
+
+    The changes of a users projects and posts are read from three indexed sources, merged in order of modification
+    time:
+
+      - projects, by their `modified` time, set when they are created, edited or have their privacy changed
+      - posts, by their `modified` time, set when they are created or edited, and when their projects privacy changes;
+        posts carry the user_id of their project, so they are found without going through the users projects
+      - tombstones, written when projects and posts are deleted
+
+    Each change is either an 'upsert' carrying the current fields of the project or post, or a 'delete'. For clients
+    that may only see non-private content, projects and posts that are now private are reported as deleted.
+
+    The position in the feed is a (modified, source, id) triple, encoded as a cursor. Changes from the last
+    CHANGES_DELAY seconds are held back, so a change committed a moment after another that has a later time is not
+    skipped by clients that read the feed in between.
+
+"""
+
+PROJECT_SOURCE = 0
+POST_SOURCE = 1
+TOMBSTONE_SOURCE = 2
+
+
+def _after(query, modified, id_, source, position):
+    """Filter a query of a source to changes after position, in (modified, source, id) order."""
+
+    if position is None:
+        return query
+
+    position_modified, position_source, position_id = position
+    if source > position_source:
+        return query.filter(modified >= position_modified)
+    if source < position_source:
+        return query.filter(modified > position_modified)
+
+    return query.filter(or_(modified > position_modified, and_(modified == position_modified, id_ > position_id)))
+
+
+def _iso(value):
+    return value.isoformat() if value is not None else None
+
+
+def get_changes(user_id, position=None, limit=100, delay=0, include_private=False):
+    """Return the changes of a users projects and posts after position, oldest first, and whether there are more.
+
+    Each change is a (position, record) pair, where record is a dict ready to be serialized to JSON. Fetches at most
+    limit + 1 rows from each source, using their (user_id, modified) indexes.
+
+    """
+
+    until = datetime.datetime.now() - datetime.timedelta(seconds=delay)
+
+    projects = db.session.query(
+        Project.id, Project.modified, Project.name, Project.title, Project.body, Project.created, Project.edited,
+        Project.private
+    ).filter(Project.user_id == user_id, Project.deleted == None, Project.modified <= until)
+    projects = _after(projects, Project.modified, Project.id, PROJECT_SOURCE, position)
+    projects = projects.order_by(Project.modified, Project.id).limit(limit + 1)
+
+    posts = db.session.query(
+        Post.id, Post.modified, Project.name, Post.post_id, Post.body, Post.created, Post.edited,
+        Post.private, Project.private
+    ).join(Project, Post.project_id == Project.id).filter(
+        Post.user_id == user_id, Project.deleted == None, Post.modified <= until)
+    posts = _after(posts, Post.modified, Post.id, POST_SOURCE, position)
+    posts = posts.order_by(Post.modified, Post.id).limit(limit + 1)
+
+    tombstones = db.session.query(
+        Tombstone.id, Tombstone.deleted, Tombstone.project_name, Tombstone.post_id
+    ).filter(Tombstone.user_id == user_id, Tombstone.deleted <= until)
+    tombstones = _after(tombstones, Tombstone.deleted, Tombstone.id, TOMBSTONE_SOURCE, position)
+    tombstones = tombstones.order_by(Tombstone.deleted, Tombstone.id).limit(limit + 1)
+
+    changes = []
+
+    for id_, modified, name, title, body, created, edited, private in projects:
+        if private and not include_private:
+            record = {'type': 'project', 'action': 'delete', 'name': name}
+        else:
+            record = {'type': 'project', 'action': 'upsert', 'name': name, 'title': title, 'body': body,
+                      'created': _iso(created), 'edited': _iso(edited)}
+        changes.append(((modified, PROJECT_SOURCE, id_), record))
+
+    for id_, modified, name, post_id, body, created, edited, private, project_private in posts:
+        if (private or project_private) and not include_private:
+            record = {'type': 'post', 'action': 'delete', 'project': name, 'post_id': post_id}
+        else:
+            record = {'type': 'post', 'action': 'upsert', 'project': name, 'post_id': post_id, 'body': body,
+                      'created': _iso(created), 'edited': _iso(edited)}
+        changes.append(((modified, POST_SOURCE, id_), record))
+
+    for id_, deleted, name, post_id in tombstones:
+        if post_id is None:
+            record = {'type': 'project', 'action': 'delete', 'name': name}
+        else:
+            record = {'type': 'post', 'action': 'delete', 'project': name, 'post_id': post_id}
+        changes.append(((deleted, TOMBSTONE_SOURCE, id_), record))
+
+    changes.sort(key=lambda change: change[0])
+
+    return changes[:limit], len(changes) > limit
+
+
+def encode_position(position):
+    modified, source, id_ = position
+    return encode_cursor(modified, source, id_)
+
+
+def add_tombstone(user_id, project_name, post_id=None):
+    """Record the deletion of a project, or of one of its posts if post_id is given. Does not commit."""
+
+    db.session.add(Tombstone(user_id=user_id, project_name=project_name, post_id=post_id,
+                             deleted=datetime.datetime.now()))
+
+
+def purge_tombstones(older_than):
+    """Delete tombstones of deletions before the datetime older_than, returning how many were deleted. Commits."""
+
+    count = Tombstone.query.filter(Tombstone.deleted < older_than).delete(synchronize_session=False)
+    db.session.commit()
+
+    return count
@@ -0,0 +1,114 @@
+import gzip
+
+from flask import current_app, g, request
+
+from projects.helpers import TTLCache
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+"""
+
+Response compression
+========================
+
+    Responses are compressed with brotli or gzip, whichever the client prefers in its Accept-Encoding header (brotli
+    on a tie, and only if the brotli package is installed). Only text responses of at least COMPRESSION_MIN_SIZE bytes
+    are compressed; streamed responses, such as /api/export, are sent as they are.
+
+    Compressed variants of responses from views with conditional requests (see projects.helpers.conditional) are kept
+    in a bounded in-process cache keyed on their ETag and encoding. The ETag describes the exact version of the
+    content, so a repeated request for unchanged content is answered from the cache without rendering or compressing
+    it again. It does not describe the encoding, so those views send it as a weak ETag. Entries are never invalidated, as any change to the content changes its ETag; stale ones age out after
+    COMPRESSION_CACHE_TTL seconds or are evicted when the cache is full.
+
+"""
+
+COMPRESSIBLE_MIMETYPES = frozenset([
+    'text/html', 'text/plain', 'text/css', 'text/xml', 'application/json', 'application/javascript',
+    'application/xml', 'application/atom+xml',
+])
+
+_compressed_cache = TTLCache()
+
+
+def init_app(app):
+    _compressed_cache.max_size = app.config.get('COMPRESSION_CACHE_SIZE', 256)
+    _compressed_cache.ttl = app.config.get('COMPRESSION_CACHE_TTL', 300)
+
+    app.after_request(compress_response)
+
+
+def available_encodings():
+    """Encodings the server can produce, in order of preference."""
+
+    return ('br', 'gzip') if brotli is not None else ('gzip',)
+
+
+def choose_encoding():
+    """Return the encoding to compress the response to the current request with, or None to send it uncompressed."""
+
+    if not current_app.config.get('COMPRESSION_ENABLED', True):
+        return None
+
+    return request.accept_encodings.best_match(available_encodings())
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=current_app.config.get('COMPRESSION_BROTLI_QUALITY', 5))
+
+    return gzip.compress(data, compresslevel=current_app.config.get('COMPRESSION_LEVEL', 6))
+
+
+def cached_response(etag):
+    """Return the cached compressed response for the content with etag, in an encoding the client accepts, or None."""
+
+    encoding = choose_encoding()
+    if encoding is None:
+        return None
+
+    cached = _compressed_cache.get((etag, encoding))
+    if cached is None:
+        return None
+
+    data, content_type = cached
+    response = current_app.response_class(data, content_type=content_type)
+    response.headers['Content-Encoding'] = encoding
+    response.vary.add('Accept-Encoding')
+
+    return response
+
+
+def compress_response(response):
+    if response.mimetype not in COMPRESSIBLE_MIMETYPES:
+        return response
+
+    # the body depends on Accept-Encoding even when this response is not compressed, e.g. because it is small
+    response.vary.add('Accept-Encoding')
+
+    if (response.status_code != 200 or response.direct_passthrough or response.is_streamed
+            or 'Content-Encoding' in response.headers):
+        return response
+
+    encoding = choose_encoding()
+    if encoding is None:
+        return response
+
+    data = response.get_data()
+    if len(data) < current_app.config.get('COMPRESSION_MIN_SIZE', 500):
+        return response
+
+    compressed = compress(data, encoding)
+    response.set_data(compressed)
+    response.headers['Content-Encoding'] = encoding
+
+    # set by conditional views whose content is fully described by their ETag
+    cache_key = g.get('compression_cache_key')
+    if cache_key is not None:
+        _compressed_cache.set((cache_key, encoding), (compressed, response.headers['Content-Type']))
+
+    return response
@@ -0,0 +1,83 @@
+import json
+
+from sqlalchemy import func
+
+from projects import db
+from projects.models import User, Project, Post
+
+
+"""
+
+Export
+========================
+
+    Projects and posts are exported as newline delimited JSON, one record per line, with a `type` of either 'project'
+    or 'post'. All project records come first, followed by all post records, each post naming the project it belongs
+    to. Only the markdown bodies are exported, html is rendered again on import.
+
+    Rows are streamed from the database as plain column tuples, in batches, so memory use does not grow with the size
+    of the export.
+
+"""
+
+PROJECT_COLUMNS = ['name', 'title', 'body', 'created', 'edited', 'private']
+POST_COLUMNS = ['post_id', 'body', 'created', 'edited', 'private']
+
+
+def export_records(user_id=None, since=None, include_private=True, batch_size=1000):
+    """Generate a line of NDJSON for every project and post.
+
+    Parameters
+    ----------
+    user_id
+        Only export the projects of this user, or of all users if None.
+    since
+        Only export projects and posts created or edited at or after this datetime, or everything if None.
+    include_private
+        Whether to export private projects and posts.
+    batch_size
+        Number of rows to fetch from the database at a time.
+
+    """
+
+    project_query = db.session.query(User.username, *[getattr(Project, column) for column in PROJECT_COLUMNS])
+    project_query = project_query.join(User, Project.user_id == User.id).order_by(Project.id)
+    project_query = _filter(project_query, Project, user_id, since, include_private)
+
+    for row in project_query.yield_per(batch_size):
+        record = {'type': 'project', 'user': row[0]}
+        record.update(zip(PROJECT_COLUMNS, row[1:]))
+        yield _dump(record)
+
+    post_query = db.session.query(Project.name, *[getattr(Post, column) for column in POST_COLUMNS])
+    post_query = post_query.join(Project, Post.project_id == Project.id).order_by(Post.project_id, Post.post_id)
+    post_query = _filter(post_query, Post, user_id, since, include_private)
+
+    for row in post_query.yield_per(batch_size):
+        record = {'type': 'post', 'project': row[0]}
+        record.update(zip(POST_COLUMNS, row[1:]))
+        yield _dump(record)
+
+
+def _filter(query, model, user_id, since, include_private):
+    """Apply the export filters to a query of model, which must already be joined to the projects table."""
+
+    query = query.filter(Project.deleted == None)
+    if user_id is not None:
+        query = query.filter(Project.user_id == user_id)
+    if not include_private:
+        query = query.filter(Project.private == False, model.private == False)
+    if since is not None:
+        query = query.filter(func.coalesce(model.edited, model.created) >= since)
+
+    return query
+
+
+def _dump(record):
+    """Serialize a record to a line of JSON, with timestamps in ISO 8601 format."""
+
+    for key in ('created', 'edited'):
+        if record[key] is not None:
+            record[key] = record[key].isoformat()
+
+    return json.dumps(record, sort_keys=True) + '\n'
@@ -0,0 +1,143 @@
+from flask import Blueprint, abort, current_app, g, render_template, url_for
+
+from projects import compression, db
+from projects.helpers import TTLCache, is_fresh, make_etag
+from projects.models import Project, Post
+
+
+"""
+
+Atom feeds
+========================
+
+    - /feed.atom  :  the latest non-private posts of all non-private projects
+    - /project/<project_name>/feed.atom  :  the latest non-private posts of a non-private project
+
+    Feeds are public, so feed readers can follow them without logging in, and hold at most FEED_ITEMS posts. Each feed
+    is cached as a complete document, with its ETag, in an in-process cache of FEED_CACHE_SIZE documents, so
+    conditional and repeated requests are answered without querying the database.
+
+    Feeds have no Last-Modified header. The newest post left in a feed does not show that posts were deleted or made
+    private, and the times of such changes can't be published without revealing activity on private content, so
+    conditional requests are answered on the ETag, a digest of the document, alone. Routes that create,
+    edit or delete projects and posts remove the feeds they appear in with `invalidate`; other processes may serve an
+    outdated feed for up to FEED_CACHE_TTL seconds.
+
+"""
+
+_feed_cache = TTLCache()
+
+
+def init_app(app):
+    _feed_cache.max_size = app.config.get('FEED_CACHE_SIZE', 256)
+    _feed_cache.ttl = app.config.get('FEED_CACHE_TTL', 300)
+
+    app.jinja_env.filters['atom_date'] = format_atom_date
+
+
+def format_atom_date(value):
+    """Format a timestamp, stored in the local time of the server, as an RFC 3339 date with its UTC offset."""
+
+    return value.astimezone().isoformat()
+
+
+def invalidate(project_name):
+    """Remove the cached feeds showing the posts of a project, e.g. after it or one of its posts changed."""
+
+    _feed_cache.delete(None)
+    _feed_cache.delete(project_name)
+
+
+def latest_posts(project_id=None):
+    """Return (post, project name, project title) rows of the newest non-private posts, of a project if project_id."""
+
+    query = db.session.query(Post, Project.name, Project.title).join(Project, Post.project_id == Project.id).filter(
+        Project.deleted == None, Project.private == False, Post.private == False)
+
+    if project_id is None:
+        query = query.order_by(Post.modified.desc(), Post.id.desc())
+    else:
+        query = query.filter(Post.project_id == project_id).order_by(Post.post_id.desc())
+
+    return query.limit(current_app.config.get('FEED_ITEMS', 20)).all()
+
+
+def render_feed(project_name=None):
+    """Return the (document, etag) of the feed of a project, or the site, or None if there is none."""
+
+    if project_name is None:
+        project = None
+        entries = latest_posts()
+        feed_url = url_for('.site_feed', _external=True)
+        alternate_url = url_for('web.index', _external=True)
+    else:
+        project = db.session.query(Project.id, Project.name, Project.title, Project.created, Project.edited).filter(
+            Project.name == project_name, Project.deleted == None, Project.private == False).first()
+        if project is None:
+            return None
+
+        entries = latest_posts(project.id)
+        feed_url = url_for('.project_feed', project_name=project.name, _external=True)
+        alternate_url = url_for('web.view_project', project_name=project.name, _external=True)
+
+    dates = [post.edited or post.created for post, _, _ in entries]
+    if project is not None:
+        dates.append(project.edited or project.created)
+    updated = max(dates) if dates else None
+
+    document = render_template('feed.xml', title=project.title if project is not None else
+                               current_app.config.get('FEED_TITLE', 'projects.campen.co'),
+                               entries=entries, updated=updated, feed_url=feed_url, alternate_url=alternate_url)
+    etag = make_etag(current_app.config.get('CACHE_VERSION'), feed_url, document)
+
+    return document, etag
+
+
+def feed_response(project_name=None):
+    # cached by project name, and the site feed under None
+    cached = _feed_cache.get(project_name)
+    if cached is None:
+        cached = render_feed(project_name)
+        if cached is None:
+            abort(404)
+        _feed_cache.set(project_name, cached)
+
+    document, etag = cached
+
+    response = None
+    if is_fresh(etag, None):
+        response = current_app.response_class(status=304)
+    else:
+        response = compression.cached_response(etag)
+
+    if response is None:
+        response = current_app.response_class(document, mimetype='application/atom+xml')
+        g.compression_cache_key = etag
+
+    # weak, as the compressed and uncompressed variants of the feed share it
+    response.set_etag(etag, weak=True)
+    # unlike the other routes, feeds are the same for everyone
+    response.cache_control.public = True
+    response.cache_control.no_cache = True
+
+    return response
+
+
+# ---------------- feed routes ---------------- #
+
+
+blueprint = Blueprint('feeds', __name__)
+
+
+@blueprint.route('/feed.atom', methods=['GET'])
+def site_feed():
+    """Returns the feed of the latest posts of all non-private projects."""
+
+    return feed_response()
+
+
+@blueprint.route('/project/<project_name>/feed.atom', methods=['GET'])
+def project_feed(project_name):
+    """Returns the feed of the latest posts of a non-private project."""
+
+    return feed_response(project_name)
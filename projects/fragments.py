@@ -0,0 +1,114 @@
+import json
+
+from flask import Markup, current_app
+
+from projects.helpers import TTLCache
+
+
+"""
+
+Fragment cache
+========================
+
+    Templates can cache the html of a block with a call block, keyed on a name, the id of the object it shows, and
+    a version that changes whenever the object does:
+
+        {% call cache_fragment('project-panel', project.id, project.edited or project.created) %}
+            ...
+        {% endcall %}
+
+    A fragment is stored under its name and id together with its version, so an entry with an old version is treated
+    as missing, and routes changing or deleting an object remove its fragments with `invalidate`. CACHE_VERSION is
+    part of every version, so changing it discards all fragments, e.g. after changing templates.
+
+    The store is chosen by FRAGMENT_CACHE:
+
+      - 'memory'  :  an in-process LRU of FRAGMENT_CACHE_SIZE entries, per uWSGI worker
+      - 'uwsgi'  :  the uWSGI cache named FRAGMENT_CACHE_UWSGI_NAME, shared by all workers of the server
+      - None  :  fragments are not cached
+
+"""
+
+
+class MemoryBackend(TTLCache):
+    """In-process LRU fragment store."""
+
+
+class UwsgiBackend(object):
+    """Fragment store in a uWSGI cache shared by the workers, configured with e.g. `cache2 = name=fragments,items=2000`.
+
+    Only available when running under uWSGI.
+
+    """
+
+    def __init__(self, name, ttl=0):
+        import uwsgi
+
+        self._uwsgi = uwsgi
+        self.name = name
+        self.ttl = ttl
+
+    def get(self, key, default=None):
+        value = self._uwsgi.cache_get(key, self.name)
+        if value is None:
+            return default
+
+        return tuple(json.loads(value.decode('utf-8')))
+
+    def set(self, key, value):
+        self._uwsgi.cache_update(key, json.dumps(value).encode('utf-8'), self.ttl, self.name)
+
+    def delete(self, key):
+        self._uwsgi.cache_del(key, self.name)
+
+    def clear(self):
+        self._uwsgi.cache_clear(self.name)
+
+
+_backend = None
+
+
+def init_app(app):
+    global _backend
+
+    backend = app.config.get('FRAGMENT_CACHE', 'memory')
+    if backend == 'memory':
+        _backend = MemoryBackend(max_size=app.config.get('FRAGMENT_CACHE_SIZE', 1000),
+                                 ttl=app.config.get('FRAGMENT_CACHE_TTL', 86400))
+    elif backend == 'uwsgi':
+        _backend = UwsgiBackend(app.config.get('FRAGMENT_CACHE_UWSGI_NAME', 'fragments'),
+                                ttl=app.config.get('FRAGMENT_CACHE_TTL', 86400))
+    else:
+        _backend = None
+
+    app.jinja_env.globals['cache_fragment'] = cache_fragment
+
+
+def _key(name, id_):
+    return 'fragment:%s:%s' % (name, id_)
+
+
+def cache_fragment(name, id_, version, caller):
+    """Return the cached html of a fragment, rendering it with caller and caching it if it is missing or outdated."""
+
+    if _backend is None:
+        return caller()
+
+    key = _key(name, id_)
+    version = '%s|%s' % (current_app.config.get('CACHE_VERSION'), version)
+
+    cached = _backend.get(key)
+    if cached is not None and cached[0] == version:
+        return Markup(cached[1])
+
+    html = caller()
+    _backend.set(key, (version, str(html)))
+
+    return Markup(html)
+
+
+def invalidate(name, id_):
+    """Remove the cached fragment of an object, e.g. after it was changed or deleted."""
+
+    if _backend is not None:
+        _backend.delete(_key(name, id_))
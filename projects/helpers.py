@@ -1,10 +1,253 @@
-from flask import Markup
-from markdown import markdown
-from CommonMark import commonmark
+import base64
+import datetime
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import Markup, current_app, g, make_response, request, session
+from flask_login import current_user
+
+from projects.metrics import timed_markdown
+
+
+CURSOR_DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+_commonmark = None
+
+
+def commonmark(text):
+    """Render markdown text with CommonMark, which is imported the first time it is needed, not at startup."""
+
+    global _commonmark
+    if _commonmark is None:
+        from CommonMark import commonmark as _commonmark
+
+    return _commonmark(text)
+
+
+def render_markdown(text):
+    """Render markdown text to an html string, for storing alongside the markdown source."""
+
+    if text is None:
+        return None
+
+    with timed_markdown():
+        return commonmark(text)
 
 
 def format_markdown(text):
 
-    common_marked = commonmark(text)
+    with timed_markdown():
+        common_marked = commonmark(text)
+
+    return Markup(common_marked)
+
+
+def format_body(obj):
+    """Return the pre-rendered html body of a Project or Post, rendering the markdown only if it is missing."""
+
+    if obj.body_html is None:
+        return format_markdown(obj.body or '')
+
+    return Markup(obj.body_html)
+
+
+def parse_timestamp(value):
+    """Parse an ISO 8601 timestamp, with or without fractional seconds. Raises ValueError if it is malformed."""
+
+    for timestamp_format in ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%d'):
+        try:
+            return datetime.datetime.strptime(value, timestamp_format)
+        except ValueError:
+            pass
+
+    raise ValueError('Invalid timestamp: %s' % value)
+
+
+def encode_cursor(created, *ids):
+    """Encode the (created, id) position of a row into an opaque pagination cursor.
+
+    More than one integer may follow the timestamp, e.g. to also tell apart rows of different tables.
+
+    """
+
+    raw = '|'.join([created.strftime(CURSOR_DATETIME_FORMAT)] + ['%d' % id_ for id_ in ids])
+
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Decode a pagination cursor back into its (created, id) position, or (created, id, ...) if it has more integers.
+
+    Raises ValueError if the cursor is malformed.
+
+    """
+
+    try:
+        raw = base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8')
+        created, ids = raw.split('|', 1)
+        created = datetime.datetime.strptime(created, CURSOR_DATETIME_FORMAT)
+        return (created,) + tuple(int(id_) for id_ in ids.split('|'))
+    except (TypeError, UnicodeError, ValueError) as e:
+        raise ValueError('Invalid cursor: %s' % e)
+
+
+def make_etag(*parts):
+    """Build an ETag value from the repr of the given parts."""
+
+    return hashlib.sha1(repr(parts).encode('utf-8')).hexdigest()
+
+
+def is_fresh(etag, last_modified):
+    """Whether the conditional headers of the current request show the client already has this version."""
+
+    if request.if_none_match:
+        # If-None-Match takes precedence over If-Modified-Since when both are sent, and compares ETags weakly
+        return request.if_none_match.contains_weak(etag)
+
+    if request.if_modified_since and last_modified is not None:
+        # http dates only have a resolution of seconds
+        return last_modified.replace(microsecond=0) <= request.if_modified_since
+
+    return False
+
+
+def conditional(get_version):
+    """Decorator adding ETag and Last-Modified headers to a view, and answering 304 without running it if unchanged.
+
+    get_version is called with the view arguments and should cheaply return (parts, last_modified) describing the
+    current version of the content, or None to run the view unconditionally (e.g. if the content does not exist).
+
+    Compressed responses are cached on their ETag (see projects.compression), so unchanged content is not rendered
+    again for clients that do not have it cached themselves. The ETag is weak, as it describes the content rather than
+    the bytes sent, which differ between the compressed and uncompressed variants.
+
+    """
+
+    def decorator(view):
+
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+
+            version = get_version(*args, **kwargs)
+            if version is None:
+                return view(*args, **kwargs)
+
+            parts, last_modified = version
+            etag = make_etag(current_app.config.get('CACHE_VERSION'), current_user.get_id(), request.full_path, parts)
+
+            # imported here, as projects.compression depends on this module
+            from projects import compression
+
+            # pending flashed messages are part of the page, so it has to be rendered to show them
+            cacheable = '_flashes' not in session
+
+            response = None
+            if cacheable:
+                if is_fresh(etag, last_modified):
+                    response = current_app.response_class(status=304)
+                else:
+                    response = compression.cached_response(etag)
+
+            if response is None:
+                response = make_response(view(*args, **kwargs))
+                if response.status_code != 200:
+                    return response
+                if cacheable:
+                    g.compression_cache_key = etag
+
+            response.set_etag(etag, weak=True)
+            if last_modified is not None:
+                response.last_modified = last_modified
+            # content is per user, and clients must revalidate before reusing it
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+
+            return response
+
+        return wrapper
+
+    return decorator
+
+
+class TTLCache(object):
+    """Thread safe, size bounded, in-process cache whose entries expire ttl seconds after they are set.
+
+    When full, the least recently used entry is evicted.
+
+    """
+
+    def __init__(self, max_size=1024, ttl=60):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return default
+
+            value, expires = entry
+            if expires < time.time():
+                del self._entries[key]
+                return default
+
+            # mark as most recently used
+            self._entries.pop(key)
+            self._entries[key] = entry
+
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, time.time() + self.ttl)
+
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class TokenBuckets(object):
+    """Thread safe, size bounded set of token buckets, one per key, for rate limiting e.g. clients.
+
+    Each bucket holds up to burst tokens and is refilled with rate tokens per second. Buckets that are not stored are
+    full, and when more than max_size are stored the least recently used one is evicted.
+
+    """
+
+    def __init__(self, rate=1.0, burst=10, max_size=10000):
+        self.rate = rate
+        self.burst = burst
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key):
+        """Take a token from the bucket of key, returning False if it is empty."""
+
+        with self._lock:
+            now = time.time()
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
 
-    return Markup(common_marked)
\ No newline at end of file
+            return allowed
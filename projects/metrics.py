@@ -0,0 +1,223 @@
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from flask import Blueprint, Response, abort, current_app, g, has_request_context, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+
+"""
+
+Metrics
+========================
+
+    Every request records its latency, the number of SQL statements it issued and the time spent running them, per
+    endpoint. Markdown rendering time is recorded as well. The metrics are served in the Prometheus text format on
+    /metrics if METRICS_ENABLED is True. The route is public, as Prometheus scrapes it without logging in, and reveals
+    the endpoints and their traffic, so it is off by default; enable it only where /metrics is not reachable from
+    outside, e.g. by blocking it in the front end web server.
+
+    Metrics are kept in memory per process, so under uWSGI each worker reports its own values; scrape the workers
+    individually or aggregate them in Prometheus.
+
+    If SLOW_REQUEST_THRESHOLD is set, requests taking longer than that many seconds are logged as warnings together
+    with the statements they issued.
+
+"""
+
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+STATEMENT_BUCKETS = [1, 2, 3, 5, 10, 20, 50, 100, 250]
+
+# most statements kept per request for the slow request log
+MAX_LOGGED_STATEMENTS = 100
+
+
+class Metric(object):
+    """Base of the metric types, holding a value per combination of label values."""
+
+    type_ = None
+
+    def __init__(self, name, help_, labels=()):
+        self.name = name
+        self.help = help_
+        self.labels = labels
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _format_labels(self, label_values, extra=None):
+        pairs = list(zip(self.labels, label_values))
+        if extra is not None:
+            pairs.append(extra)
+        if not pairs:
+            return ''
+        return '{%s}' % ','.join('%s="%s"' % (key, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                                 for key, value in pairs)
+
+    def render(self):
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type_)]
+        with self._lock:
+            for label_values, value in sorted(self._values.items()):
+                lines.extend(self._render_value(label_values, value))
+        return lines
+
+
+class Counter(Metric):
+    """Monotonically increasing count."""
+
+    type_ = 'counter'
+
+    def inc(self, *label_values, **kwargs):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + kwargs.get('amount', 1)
+
+    def _render_value(self, label_values, value):
+        return ['%s%s %s' % (self.name, self._format_labels(label_values), value)]
+
+
+class Histogram(Metric):
+    """Distribution of observed values over fixed buckets."""
+
+    type_ = 'histogram'
+
+    def __init__(self, name, help_, buckets, labels=()):
+        super(Histogram, self).__init__(name, help_, labels)
+        self.buckets = buckets
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                # a count per bucket, then the count and sum of all observations
+                counts = self._values[label_values] = [0] * len(self.buckets) + [0, 0.0]
+            index = bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                counts[index] += 1
+            counts[-2] += 1
+            counts[-1] += value
+
+    def _render_value(self, label_values, counts):
+        lines = []
+        cumulative = 0
+        for bucket, count in zip(self.buckets, counts):
+            cumulative += count
+            lines.append('%s_bucket%s %d' % (self.name, self._format_labels(label_values, ('le', bucket)),
+                                             cumulative))
+        lines.append('%s_bucket%s %d' % (self.name, self._format_labels(label_values, ('le', '+Inf')), counts[-2]))
+        lines.append('%s_count%s %d' % (self.name, self._format_labels(label_values), counts[-2]))
+        lines.append('%s_sum%s %r' % (self.name, self._format_labels(label_values), counts[-1]))
+        return lines
+
+
+REGISTRY = []
+
+requests_total = Counter('microblog_requests_total', 'Requests handled.', labels=('endpoint', 'status'))
+request_duration = Histogram('microblog_request_duration_seconds', 'Request latency.', LATENCY_BUCKETS,
+                             labels=('endpoint',))
+request_statements = Histogram('microblog_request_sql_statements', 'SQL statements issued per request.',
+                               STATEMENT_BUCKETS, labels=('endpoint',))
+request_sql_duration = Histogram('microblog_request_sql_duration_seconds', 'Time spent in SQL per request.',
+                                 LATENCY_BUCKETS, labels=('endpoint',))
+markdown_render_duration = Histogram('microblog_markdown_render_seconds', 'Time spent rendering markdown.',
+                                     LATENCY_BUCKETS)
+
+
+def render_metrics():
+    """Return all metrics in the Prometheus text exposition format."""
+
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+
+    return '\n'.join(lines) + '\n'
+
+
+# ---------------- request and SQL instrumentation ---------------- #
+
+
+blueprint = Blueprint('metrics', __name__)
+
+
+@blueprint.before_app_request
+def start_request_metrics():
+    g.metrics_started = time.time()
+    g.sql_statements = 0
+    g.sql_duration = 0.0
+    g.sql_log = [] if current_app.config.get('SLOW_REQUEST_THRESHOLD') is not None else None
+
+
+@blueprint.after_app_request
+def record_request_metrics(response):
+    started = getattr(g, 'metrics_started', None)
+    if started is None:
+        return response
+
+    duration = time.time() - started
+    endpoint = request.endpoint or 'unknown'
+
+    requests_total.inc(endpoint, response.status_code)
+    request_duration.observe(duration, endpoint)
+    request_statements.observe(g.sql_statements, endpoint)
+    request_sql_duration.observe(g.sql_duration, endpoint)
+
+    threshold = current_app.config.get('SLOW_REQUEST_THRESHOLD')
+    if threshold is not None and duration > threshold:
+        statements = '\n'.join('  %.1fms  %s' % (statement_duration * 1000, statement)
+                               for statement, statement_duration in g.sql_log or [])
+        current_app.logger.warning('Slow request: %s %s took %.1fms, %d SQL statements in %.1fms\n%s',
+                                   request.method, request.full_path, duration * 1000, g.sql_statements,
+                                   g.sql_duration * 1000, statements)
+
+    return response
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement_metrics(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('metrics_started', []).append(time.time())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def record_statement_metrics(conn, cursor, statement, parameters, context, executemany):
+    duration = time.time() - conn.info['metrics_started'].pop()
+
+    if not has_request_context() or getattr(g, 'metrics_started', None) is None:
+        return
+
+    g.sql_statements += 1
+    g.sql_duration += duration
+    if g.sql_log is not None and len(g.sql_log) < MAX_LOGGED_STATEMENTS:
+        g.sql_log.append((statement, duration))
+
+
+@event.listens_for(Engine, 'handle_error')
+def discard_statement_metrics(context):
+    # after_cursor_execute is not called for failed statements, so drop their start time here
+    started = context.connection.info.get('metrics_started') if context.connection is not None else None
+    if started:
+        started.pop()
+
+
+@contextmanager
+def timed_markdown():
+    """Context manager recording the time spent rendering markdown."""
+
+    started = time.time()
+    try:
+        yield
+    finally:
+        markdown_render_duration.observe(time.time() - started)
+
+
+# ---------------- metrics route ---------------- #
+
+
+@blueprint.route('/metrics', methods=['GET'])
+def metrics():
+    """Returns the metrics of this process in the Prometheus text format."""
+
+    if not current_app.config.get('METRICS_ENABLED', False):
+        abort(404)
+
+    return Response(render_metrics(), mimetype='text/plain; version=0.0.4')
@@ -1,10 +1,47 @@
 import random
 
 from projects import db
+from projects.helpers import encode_cursor, decode_cursor
+from sqlalchemy import and_, or_, func
+from sqlalchemy.orm import Query
 from sqlalchemy_utils import PasswordType, force_auto_coercion
 
 
-force_auto_coercion()
+# words that random page names are built from, see Project.generate_page_name
+PAGE_NAME_WORDS = {
+    'adjectives': ['Melodic', 'Fluffy', 'Climbing', 'Whispering', 'Thundering', 'Crooked', 'Shallow', 'Obnoxious', 'Bewildered', 'Jolly', 'Agreeable', 'Gifted', 'Handsome', 'Drab', 'Magnificent', 'Boiling', 'Bumpy', 'Cuddly', 'Abundant', 'Sparse'],
+    'colors': ['Amber', 'Auburn', 'Azure', 'Beige', 'Brass', 'Carmine', 'Cerulean', 'Champagne', 'Cinnabar', 'Crimson', 'Cyan', 'Ebony', 'Fuchsia', 'Ginger', 'Indigo', 'Lavender', 'Lemon', 'Mahogany', 'Mauve', 'Ochre', 'Olive', 'Scarlet', 'Tan', 'Maroon', 'Vermillion', 'Tangerine', 'Viridian', 'Violet'],
+    'animals': ['Aardvark', 'Alligator', 'Alpaca', 'Armadillo', 'Buffalo', 'Caribou', 'Cheetah', 'Chinchilla', 'Dugong', 'Eagle', 'Echidna', 'Emu', 'Flamingo', 'Gazelle', 'Giraffe', 'Goose', 'Grouse', 'Hippo', 'Ibex', 'Jackal', 'Jaguar', 'Kangaroo', 'Llama', 'Lion', 'Mallard', 'Mongoose', 'Marwhal', 'Owl', 'Panther', 'Parrot', 'Penguin', 'Raven', 'Rhino', 'Seal', 'Squirrel', 'Swan', 'Tapir', 'Tiger', 'Turkey', 'Wallaby', 'Walrus', 'Wombat', 'Yak', 'Zebra']
+}
+
+# the first word of two word names is an adjective or a color
+FIRST_WORDS = PAGE_NAME_WORDS['adjectives'] + PAGE_NAME_WORDS['colors']
+
+_random = random.SystemRandom()
+
+
+def _random_page_name(tier):
+    """Return a random page name from the given tier of the page name space.
+
+    Tiers get progressively larger: ~2,100 two word names, ~25,000 three word names, ~21 million two word names with a
+    number suffix, and finally two word names with a random hex suffix, which never run out.
+
+    """
+
+    first = _random.choice(FIRST_WORDS)
+    animal = _random.choice(PAGE_NAME_WORDS['animals'])
+
+    if tier == 0:
+        return first + animal
+    elif tier == 1:
+        return _random.choice(PAGE_NAME_WORDS['adjectives']) + _random.choice(PAGE_NAME_WORDS['colors']) + animal
+    elif tier == 2:
+        return '%s%s%d' % (first, animal, _random.randint(2, 9999))
+    else:
+        return '%s%s%08x' % (first, animal, _random.getrandbits(32))
+
+
+PAGE_NAME_TIERS = 4
 
 
 class User(db.Model):
@@ -21,18 +58,25 @@ class User(db.Model):
         Unique username used to login.
     password_hash
         Hash of users password.
-    api_token
-        API token used for restricted API access
+    api_token_id
+        Public, indexed, part of the users API token, used to look the user up (see projects.auth)
+    api_token_digest
+        SHA-256 digest of the secret part of the users API token
+    session_version
+        Part of the id stored in login sessions, incremented to end all sessions of the user (see projects.auth)
 
-    """
+    The password and API token digest are deferred, they are only loaded when accessed, or with e.g.
+    `undefer('password')`.
 
-    #TODO: add api key column, and methods for generating/regenerating the api key.
+    """
 
     __tablename__ = 'users'
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(32), index=True, unique=True)
-    password = db.Column(PasswordType(schemes=['pbkdf2_sha512']), nullable=False)
-    api_token = db.Column(PasswordType(schemes=['pbkdf2_sha512']))
+    password = db.deferred(db.Column(PasswordType(schemes=['pbkdf2_sha512']), nullable=False))
+    api_token_id = db.Column(db.String(16), index=True, unique=True)
+    api_token_digest = db.deferred(db.Column(db.String(64)))
+    session_version = db.Column(db.Integer, nullable=False, default=0, server_default='0')
 
     projects = db.relationship('Project', backref='user', lazy='dynamic', cascade="all, delete, delete-orphan")
 
@@ -49,16 +93,28 @@ class User(db.Model):
         return False
 
     def get_id(self):
-        return str(self.id)
+        # the session version is stored in the session with the id, see projects.auth.load_user
+        return '%d:%d' % (self.id, self.session_version or 0)
+
+    def change_password(self, password):
+        """Set a new password, ending all existing sessions of the user. Does not commit."""
+
+        self.password = password
+        self.end_sessions()
 
-    def change_password(self, username):
-        # TODO implement
-        pass
+    def end_sessions(self):
+        """Invalidate all existing login sessions of the user. Does not commit."""
+
+        self.session_version = User.session_version + 1
 
     def __repr__(self):
         return '<User %r>' % self.username
 
 
+# coerce passwords assigned to users into hashes right away; no other model has columns that need coercion
+force_auto_coercion(User)
+
+
 class Project(db.Model):
     """Page table object representation.
 
@@ -72,50 +128,221 @@ class Project(db.Model):
     id
         Unique auto incrementing identifier.
     name
-        Page name (unique)
+        Page name (unique), see Project.generate_page_names
     title
         Title of the project
-    description
+    body
         Brief descriptive overview of the project, saved for editing
-    description_htl
-        The description but rendered as html, for display
+    body_html
+        The body but rendered as html, for display
     created
         When the Project was first created
     edited
         When the Project was last edited
+    modified
+        When the Project was created, last edited or had its privacy changed, for the API change feed
     private
         Whether the Project is private, and therefore visible to the API
+    next_post_id
+        The post_id that will be given to the next post created for this Project
+    deleted
+        When the Project was deleted, if it is hidden and waiting for its rows to be purged
     posts
         Posts linked to this Project
 
     """
 
     __tablename__ = 'projects'
+    __table_args__ = (
+        # looking a project up by name, always within the projects of the current user
+        db.Index('ix_projects_user_id_name', 'user_id', 'name'),
+        # listings of a users (non-private) projects, newest first
+        db.Index('ix_projects_user_id_private_created', 'user_id', 'private', 'created'),
+        # listings including private projects, in (created, id) order
+        db.Index('ix_projects_user_id_created_id', 'user_id', 'created', 'id'),
+        db.Index('ix_projects_user_id_modified', 'user_id', 'modified'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String, index=True, nullable=False)
+    name = db.Column(db.String, index=True, unique=True, nullable=False)
     title = db.Column(db.String)
     body = db.Column(db.String)
+    body_html = db.Column(db.String)
     created = db.Column(db.DateTime, nullable=False)
     edited = db.Column(db.DateTime)
+    modified = db.Column(db.DateTime)
     private = db.Column(db.Boolean, nullable=False, default=True)
+    next_post_id = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    deleted = db.Column(db.DateTime)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
 
     posts = db.relationship('Post', backref='project', lazy='dynamic', cascade="all, delete, delete-orphan")
 
     @staticmethod
-    def generate_page_name():
+    def get_page(user_id, cursor=None, limit=20, include_private=True, columns=None):
+        """Return a page of a users projects, newest first, and the cursor for the following page.
+
+        Pages are keyed on (created, id) rather than offsets, so each page costs the same to fetch no matter how
+        deep into the listing it is. The cursor for the following page is None when there are no more projects.
+        If columns are given, rows of just those columns are returned instead of Project instances.
+        Raises ValueError if cursor is malformed.
+
+        """
+
+        projects = project_page_query(user_id, cursor, limit, include_private, columns).with_session(
+            db.session()).all()
+
+        next_cursor = None
+        if len(projects) > limit:
+            projects = projects[:limit]
+            if columns is None:
+                next_cursor = encode_cursor(projects[-1].created, projects[-1].id)
+            else:
+                next_cursor = encode_cursor(projects[-1].cursor_created, projects[-1].cursor_id)
+
+        return projects, next_cursor
+
+    @staticmethod
+    def get_list_version(user_id, include_private=True):
+        """Return (parts, last_modified) describing the current version of a users project listing."""
+
+        return list_version(list_version_query(user_id, include_private).with_session(db.session()).one())
+
+    @staticmethod
+    def get_version(user_id, name):
+        """Return (parts, last_modified) describing the current version of a project and its posts, or None."""
+
+        return project_version(project_version_query(user_id, name).with_session(db.session()).first())
+
+    def get_latest_post(self, include_private=True):
+        """Return the most recent post of the project, or None if it has no (visible) posts."""
+
+        query = self.posts
+        if not include_private:
+            query = query.filter_by(private=False)
+
+        return query.order_by(Post.post_id.desc()).first()
+
+    def get_post_neighbours(self, post_id, include_private=True):
+        """Return the post_ids of the posts either side of post_id as (older, newer), None where there is no post.
+
+        Only post_ids are queried, so navigating a project never loads the bodies of the surrounding posts.
+
+        """
+
+        query = db.session.query(Post.post_id).filter(Post.project_id == self.id)
+        if not include_private:
+            query = query.filter(Post.private == False)
 
-        word_dict = {
-            'adjectives': ['Melodic', 'Fluffy', 'Climbing', 'Whispering', 'Thundering', 'Crooked', 'Shallow', 'Obnoxious', 'Bewildered', 'Jolly', 'Agreeable', 'Gifted', 'Handsome', 'Drab', 'Magnificent', 'Boiling', 'Bumpy', 'Cuddly', 'Abundant', 'Sparse'],
-            'colors': ['Amber', 'Auburn', 'Azure', 'Beige', 'Brass', 'Carmine', 'Cerulean', 'Champagne', 'Cinnabar', 'Crimson', 'Cyan', 'Ebony', 'Fuchsia', 'Ginger', 'Indigo', 'Lavender', 'Lemon', 'Mahogany', 'Mauve', 'Ochre', 'Olive', 'Scarlet', 'Tan', 'Maroon', 'Vermillion', 'Tangerine', 'Viridian', 'Violet'],
-            'animals': ['Aardvark', 'Alligator', 'Alpaca', 'Armadillo', 'Buffalo', 'Caribou', 'Cheetah', 'Chinchilla', 'Dugong', 'Eagle', 'Echidna', 'Emu', 'Flamingo', 'Gazelle', 'Giraffe', 'Goose', 'Grouse', 'Hippo', 'Ibex', 'Jackal', 'Jaguar', 'Kangaroo', 'Llama', 'Lion', 'Mallard', 'Mongoose', 'Marwhal', 'Owl', 'Panther', 'Parrot', 'Penguin', 'Raven', 'Rhino', 'Seal', 'Squirrel', 'Swan', 'Tapir', 'Tiger', 'Turkey', 'Wallaby', 'Walrus', 'Wombat', 'Yak', 'Zebra']
-        }
+        older = query.filter(Post.post_id < post_id).order_by(Post.post_id.desc()).limit(1).scalar()
+        newer = query.filter(Post.post_id > post_id).order_by(Post.post_id.asc()).limit(1).scalar()
+
+        return older, newer
+
+    @staticmethod
+    def delete_project(project_id):
+        """Delete a project and all of its posts with one statement per table.
+
+        Does not commit, so the deletion happens in the callers transaction.
+
+        """
+
+        Post.query.filter_by(project_id=project_id).delete(synchronize_session=False)
+        Project.query.filter_by(id=project_id).delete(synchronize_session=False)
+
+    @staticmethod
+    def purge_project(project_id, batch_size=1000):
+        """Delete a project and all of its posts, committing after each batch of posts.
+
+        Used for projects that have already been soft deleted, so that deleting a project with a very large number of
+        posts never holds its locks for long.
+
+        """
 
         while True:
-            name = ''.join([random.SystemRandom().choice(word_dict['adjectives'] + word_dict['colors']),
-                            random.SystemRandom().choice(word_dict['animals'])])
-            if Project.query.filter_by(name=name).first() is None:
-                return name
+            batch = db.session.query(Post.id).filter_by(project_id=project_id).limit(batch_size).subquery()
+            deleted = Post.query.filter(Post.id.in_(batch)).delete(synchronize_session=False)
+            db.session.commit()
+            if deleted < batch_size:
+                break
+
+        Project.query.filter_by(id=project_id).delete(synchronize_session=False)
+        db.session.commit()
+
+    @staticmethod
+    def mark_posts_modified(project_id, modified):
+        """Set the modified time of all posts of a project, e.g. when its privacy changes. Does not commit."""
+
+        Post.query.filter_by(project_id=project_id).update({'modified': modified}, synchronize_session=False)
+
+    @staticmethod
+    def allocate_post_id(project_id):
+        """Reserve the next post_id for a project.
+
+        The counter is incremented in the database, so the projects row stays locked until the surrounding
+        transaction ends and concurrent writers are handed distinct ids.
+
+        """
+
+        Project.query.filter_by(id=project_id).update({Project.next_post_id: Project.next_post_id + 1},
+                                                      synchronize_session=False)
+
+        return db.session.query(Project.next_post_id).filter_by(id=project_id).scalar() - 1
+
+    @staticmethod
+    def resync_post_id(project_id):
+        """Move a projects post_id counter past its highest existing post_id, e.g. after a post_id conflict."""
+
+        max_post_id = db.session.query(func.max(Post.post_id)).filter_by(project_id=project_id).scalar() or 0
+        Project.query.filter_by(id=project_id).filter(Project.next_post_id <= max_post_id).update(
+            {Project.next_post_id: max_post_id + 1}, synchronize_session=False)
+        db.session.commit()
+
+    @staticmethod
+    def find_used_names(names, chunk_size=500):
+        """Return the subset of names that are already used by a project, with a query per chunk_size names."""
+
+        names = list(names)
+        used = set()
+        for start in range(0, len(names), chunk_size):
+            chunk = names[start:start + chunk_size]
+            used.update(name for name, in db.session.query(Project.name).filter(Project.name.in_(chunk)))
+
+        return used
+
+    @staticmethod
+    def generate_page_name():
+        """Return a random page name that is not in use."""
+
+        return Project.generate_page_names(1)[0]
+
+    @staticmethod
+    def generate_page_names(count, exclude=(), attempts=3):
+        """Return count distinct random page names that are not in use and not in exclude.
+
+        Each attempt draws a batch of random candidates from a tier of the name space and checks them with a single
+        query. The shortest names are used first, and after a few attempts that don't find enough unused names the
+        next, larger, tier is used, so the number of queries stays bounded however full the name space gets. The
+        names are only reserved by inserting them; projects.name is unique, so callers should retry on an
+        IntegrityError. Raises ValueError if no unused names could be found.
+
+        """
+
+        names = []
+        taken = set(exclude)
+
+        for tier in range(PAGE_NAME_TIERS):
+            for attempt in range(attempts):
+                needed = count - len(names)
+                candidates = set(_random_page_name(tier) for _ in range(max(needed * 2, 16))) - taken
+                taken.update(candidates)
+
+                unused = candidates - Project.find_used_names(candidates)
+                names.extend(list(unused)[:needed])
+                if len(names) == count:
+                    return names
+
+        raise ValueError('Could not find %d unused page names' % count)
 
     def __repr__(self):
         return '<Project %r>' % self.id
@@ -134,22 +361,227 @@ class Post(db.Model):
     id
         Unique auto incrementing identifier.
     post_id
-        Unique auto incrementing identifier for the posts for a specific project
-    content
-        Main content of post
+        Unique auto incrementing identifier for the posts for a specific project, allocated from
+        Project.next_post_id
+    body
+        Main content of post, saved for editing
+    body_html
+        The body but rendered as html, for display
+    modified
+        When the Post was created or last edited, or its projects privacy changed, for the API change feed
+    user_id
+        Owner of the project of the Post, copied from it so the change feed can find a users posts by modified time
 
     """
 
     __tablename__ = 'posts'
+    __table_args__ = (
+        db.UniqueConstraint('project_id', 'post_id'),
+        # the latest (non-private) posts of a project
+        db.Index('ix_posts_project_id_private_post_id', 'project_id', 'private', 'post_id'),
+        # the change feed of a user, in (modified, id) order
+        db.Index('ix_posts_user_id_modified_id', 'user_id', 'modified', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     post_id = db.Column(db.Integer, nullable=False)
     title = db.Column(db.String)
     body = db.Column(db.Text)
+    body_html = db.Column(db.Text)
     created = db.Column(db.DateTime, nullable=False)
     edited = db.Column(db.DateTime)
+    modified = db.Column(db.DateTime, index=True)
     private = db.Column(db.Boolean, nullable=False, default=True)
 
     project_id = db.Column(db.Integer, db.ForeignKey('projects.id'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'))
+
+    @staticmethod
+    def delete_post(project_id, post_id):
+        """Delete a single post of a project, returning the number of posts deleted. Does not commit."""
+
+        return Post.query.filter_by(project_id=project_id, post_id=post_id).delete(synchronize_session=False)
 
     def __repr__(self):
         return '<Project %r>.<Post %r>' % (self.project_id, self.id)
+
+
+class Tombstone(db.Model):
+    """Record of a deleted project or post, for the API change feed.
+
+    Columns
+    -------
+    id
+        Unique auto incrementing identifier.
+    user_id
+        Owner of the deleted project
+    project_name
+        Name of the deleted project, or of the project of the deleted post
+    post_id
+        post_id of the deleted post, or None if the whole project was deleted
+    deleted
+        When the project or post was deleted
+
+    """
+
+    __tablename__ = 'tombstones'
+    __table_args__ = (
+        db.Index('ix_tombstones_user_id_deleted', 'user_id', 'deleted'),
+        # the last deletion of a post of a project, for its version
+        db.Index('ix_tombstones_user_id_project_name_deleted', 'user_id', 'project_name', 'deleted'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    project_name = db.Column(db.String, nullable=False)
+    post_id = db.Column(db.Integer)
+    deleted = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return '<Tombstone %r>.<Post %r>' % (self.project_name, self.post_id)
+
+
+class Job(db.Model):
+    """Background job table object representation, see projects.tasks.
+
+    Columns
+    -------
+    id
+        Unique auto incrementing identifier.
+    name
+        Name of the task to run
+    args
+        JSON object of the keyword arguments to run the task with
+    status
+        'pending' until a worker claims the job, then 'running'. Jobs are deleted once they succeed, and left as
+        'failed' once they run out of attempts
+    attempts
+        Number of times the job has been started
+    run_at
+        When the job is next due to run
+    locked_at
+        When a worker last claimed the job, for reclaiming jobs of workers that died
+    last_error
+        Traceback of the last failed attempt
+    created
+        When the job was enqueued
+
+    """
+
+    __tablename__ = 'jobs'
+    __table_args__ = (
+        db.Index('ix_jobs_status_run_at', 'status', 'run_at'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(64), nullable=False)
+    args = db.Column(db.Text, nullable=False)
+    status = db.Column(db.String(16), nullable=False)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    run_at = db.Column(db.DateTime, nullable=False)
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+    created = db.Column(db.DateTime, nullable=False)
+
+    def __repr__(self):
+        return '<Job %r %r>' % (self.id, self.name)
+
+
+# ---------------- shared queries ---------------- #
+# built without a session, so the async API (see projects.asgi) runs the same queries as the Flask routes, which run
+# them on db.session with Query.with_session
+
+
+def project_page_query(user_id, cursor=None, limit=20, include_private=True, columns=None):
+    """Return the Query of a page of a users projects, newest first, see Project.get_page.
+
+    Rows are Project instances, or if columns are given rows of those columns followed by the created time and id of
+    the project for the cursor. One row more than limit is fetched, to find out whether there is a following page.
+    Raises ValueError if cursor is malformed.
+
+    """
+
+    if columns is None:
+        query = Query(Project)
+    else:
+        # the position of the last row is needed for the cursor, whichever columns were asked for
+        query = Query(list(columns)).add_columns(Project.created.label('cursor_created'),
+                                                 Project.id.label('cursor_id'))
+
+    query = query.filter(Project.user_id == user_id, Project.deleted == None)
+    if not include_private:
+        query = query.filter(Project.private == False)
+
+    if cursor is not None:
+        created, id_ = decode_cursor(cursor)
+        query = query.filter(or_(Project.created < created,
+                                 and_(Project.created == created, Project.id < id_)))
+
+    return query.order_by(Project.created.desc(), Project.id.desc()).limit(limit + 1)
+
+
+def _modified(model):
+    """Expression for when a project or post last changed, for rows from before the modified column was filled in."""
+
+    return func.coalesce(model.modified, model.edited, model.created)
+
+
+def _latest(*times):
+    times = [time for time in times if time is not None]
+    return max(times) if times else None
+
+
+def list_version_query(user_id, include_private=True):
+    """Return the Query of the aggregates describing the current version of a users project listing.
+
+    Only aggregates are queried, so checking whether a listing has changed never loads any projects. Deleted projects
+    no longer show up in the aggregates of the remaining ones, so the time of the users last deletion is queried too,
+    from the tombstones of the change feed; those of posts included, which only makes the version change more often.
+
+    """
+
+    last_deleted = Query([func.max(Tombstone.deleted)]).filter(Tombstone.user_id == user_id).as_scalar()
+
+    query = Query([func.count(Project.id), func.max(Project.id), func.max(_modified(Project)), last_deleted])
+    query = query.filter(Project.user_id == user_id, Project.deleted == None)
+    if not include_private:
+        query = query.filter(Project.private == False)
+
+    return query
+
+
+def list_version(row):
+    """Return (parts, last_modified) from the row of list_version_query."""
+
+    count, max_id, last_changed, last_deleted = row
+
+    return (count, max_id, last_changed, last_deleted), _latest(last_changed, last_deleted)
+
+
+def project_version_query(user_id, name):
+    """Return the Query of the aggregates describing the current version of a project and its posts.
+
+    Only aggregates are queried, so checking whether a project has changed never loads any post bodies. There is no
+    row if the project does not exist. As with listings, the time of the last deletion of one of its posts is queried
+    from the tombstones, as the remaining posts do not show it.
+
+    """
+
+    last_deleted = Query([func.max(Tombstone.deleted)]).filter(
+        Tombstone.user_id == user_id, Tombstone.project_name == name).as_scalar()
+
+    return Query([
+        Project.id, _modified(Project), func.count(Post.id), func.max(Post.post_id), func.max(_modified(Post)),
+        last_deleted
+    ]).outerjoin(Post, Post.project_id == Project.id).filter(
+        Project.user_id == user_id, Project.name == name, Project.deleted == None
+    ).group_by(Project.id, Project.modified, Project.edited, Project.created)
+
+
+def project_version(row):
+    """Return (parts, last_modified) from the row of project_version_query, or None if there was no row."""
+
+    if row is None:
+        return None
+
+    return tuple(row), _latest(row[1], row[4], row[5])
@@ -0,0 +1,146 @@
+import itertools
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from flask import g, has_request_context, session
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+from sqlalchemy import create_engine, event, orm, text
+
+
+"""
+
+Read replicas
+========================
+
+    Read-only routes (decorated with `read_only`) run their queries on one of the read replicas listed in
+    SQLALCHEMY_REPLICA_URIS. A replica is picked round-robin once per request, so all of its reads see the same
+    snapshot. Every other route, and anything flushed or run within `primary()`, uses the primary database from
+    SQLALCHEMY_DATABASE_URI. Without replicas everything uses the primary.
+
+    Each replica is checked with a `SELECT 1` at most every REPLICA_CHECK_INTERVAL seconds, and whenever a query on it
+    fails with a disconnect. Unhealthy replicas are skipped until a check succeeds, and if none are healthy reads go to
+    the primary.
+
+    Replicas lag behind the primary, so once a browser session commits a change its reads stay on the primary for
+    REPLICA_READ_YOUR_WRITES seconds, long enough for the page redirected to after the change to show it.
+
+"""
+
+
+class Replica(object):
+    """A read replica engine and its health."""
+
+    def __init__(self, uri):
+        self.engine = create_engine(uri)
+        self.healthy = True
+        self.next_check = 0
+
+        @event.listens_for(self.engine, 'handle_error')
+        def check_disconnect(context):
+            if context.is_disconnect:
+                self.healthy = False
+                self.next_check = 0
+
+
+class ReplicaSet(object):
+    """Round-robin selection over the healthy replicas."""
+
+    def __init__(self, uris, check_interval=30):
+        self.replicas = [Replica(uri) for uri in uris]
+        self.check_interval = check_interval
+        self._counter = itertools.count()
+
+    def check(self, replica):
+        replica.next_check = time.time() + self.check_interval
+        try:
+            with replica.engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+            replica.healthy = True
+        except Exception as e:
+            print('[ERROR]: ', e)
+            replica.healthy = False
+
+    def choose(self):
+        """Return the engine of the next healthy replica, or None if there are none."""
+
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[next(self._counter) % len(self.replicas)]
+            if replica.next_check <= time.time():
+                self.check(replica)
+            if replica.healthy:
+                return replica.engine
+
+        return None
+
+
+class RoutingSession(SignallingSession):
+    """Session sending the reads of read-only requests to a replica, and everything else to the primary."""
+
+    def __init__(self, db, *args, **kwargs):
+        super(RoutingSession, self).__init__(db, *args, **kwargs)
+        self.replicas = self.app.extensions['replicas']
+
+    def get_bind(self, mapper=None, clause=None):
+        if not self._flushing and has_request_context() and g.get('use_replica'):
+            if 'replica_engine' not in g:
+                g.replica_engine = self.replicas.choose()
+            if g.replica_engine is not None:
+                return g.replica_engine
+
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def pin_to_primary(db_session):
+    # the rest of this request, and the next requests of this browser session, read their own writes from the primary
+    if has_request_context():
+        g.use_replica = False
+        g.wrote_to_primary = True
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """SQLAlchemy extension whose sessions route read-only requests to the replicas in SQLALCHEMY_REPLICA_URIS."""
+
+    def init_app(self, app):
+        super(RoutingSQLAlchemy, self).init_app(app)
+
+        app.extensions['replicas'] = ReplicaSet(app.config.get('SQLALCHEMY_REPLICA_URIS', ()),
+                                                check_interval=app.config.get('REPLICA_CHECK_INTERVAL', 30))
+
+        @app.after_request
+        def remember_write(response):
+            if g.get('wrote_to_primary'):
+                session['primary_until'] = time.time() + app.config.get('REPLICA_READ_YOUR_WRITES', 10)
+            return response
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def read_only(view):
+    """Decorator letting a view read from a replica, unless the browser session recently wrote to the primary."""
+
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        if session.get('primary_until', 0) < time.time():
+            g.use_replica = True
+        return view(*args, **kwargs)
+
+    return wrapper
+
+
+@contextmanager
+def primary():
+    """Context manager running the statements issued within it on the primary, e.g. for writes in a read-only view."""
+
+    if not has_request_context():
+        yield
+        return
+
+    use_replica = g.get('use_replica')
+    g.use_replica = False
+    try:
+        yield
+    finally:
+        g.use_replica = use_replica
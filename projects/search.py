@@ -0,0 +1,311 @@
+import re
+
+from flask import Markup, current_app, escape
+from sqlalchemy import text
+from sqlalchemy.orm import contains_eager
+
+from projects import db
+from projects.models import Project, Post
+
+
+"""
+
+Full text search
+========================
+
+    Projects and posts are indexed in a `search_index` table that lives in the application database. The index type
+    is chosen from SQLALCHEMY_DATABASE_URI:
+
+      - sqlite  :  an FTS5 virtual table ranked with bm25
+      - postgresql  :  a tsvector column with a GIN index ranked with ts_rank
+
+    Any other database disables search. The index is updated by the create/edit/delete routes in the same transaction
+    as the content it describes, and can be rebuilt from scratch with scripts/build_search_index.py.
+
+    The index is created if it does not exist before the first request of each process (and when a worker starts), on
+    a connection of its own that is committed right away, so it never depends on the transaction of a request or job
+    that may be rolled back, e.g. of a read-only route.
+
+    Every project and post is one document. Documents are keyed on an integer derived from the row id (even for
+    projects, odd for posts) so they can be updated and removed by key lookups, without scanning the index. Post
+    documents only hold the post body; the project title is looked up when results are formatted.
+
+"""
+
+# markers placed around matched terms by the database, swapped for <mark> tags once the snippet is escaped
+HIGHLIGHT_START = '\x02'
+HIGHLIGHT_END = '\x03'
+
+# document keys of the posts of a project
+POST_KEYS = "(SELECT id * 2 + 1 FROM posts WHERE project_id = :project_id)"
+
+
+class SqliteBackend(object):
+    """Search index stored in an SQLite FTS5 virtual table, keyed on its rowid."""
+
+    key = 'rowid'
+
+    create_statements = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+        "title, body, user_id UNINDEXED, project_id UNINDEXED, post_id UNINDEXED, private UNINDEXED, "
+        "project_private UNINDEXED, tokenize='porter unicode61')",
+    ]
+
+    insert_statement = (
+        "INSERT INTO search_index (rowid, title, body, user_id, project_id, post_id, private, project_private) "
+        "VALUES (:key, :title, :body, :user_id, :project_id, :post_id, :private, :project_private)"
+    )
+
+    search_statement = (
+        "SELECT project_id, post_id, "
+        "snippet(search_index, 1, '" + HIGHLIGHT_START + "', '" + HIGHLIGHT_END + "', '...', 24) AS snippet "
+        "FROM search_index WHERE search_index MATCH :query AND user_id = :user_id {private_filter} "
+        "ORDER BY bm25(search_index, 10.0, 1.0) LIMIT :limit OFFSET :offset"
+    )
+
+    @staticmethod
+    def make_query(terms):
+        # quote every term so user input can never be read as FTS5 query syntax
+        return ' '.join('"%s"' % term.replace('"', '""') for term in terms)
+
+
+class PostgresBackend(object):
+    """Search index stored in a table with a weighted tsvector column and a GIN index."""
+
+    key = 'doc_id'
+
+    create_statements = [
+        "CREATE TABLE IF NOT EXISTS search_index ("
+        "doc_id BIGINT PRIMARY KEY, user_id INTEGER NOT NULL, project_id INTEGER NOT NULL, post_id INTEGER, "
+        "private BOOLEAN NOT NULL, project_private BOOLEAN NOT NULL, title VARCHAR, body TEXT, "
+        "document TSVECTOR NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS ix_search_index_document ON search_index USING GIN (document)",
+    ]
+
+    insert_statement = (
+        "INSERT INTO search_index "
+        "(doc_id, title, body, user_id, project_id, post_id, private, project_private, document) "
+        "VALUES (:key, :title, :body, :user_id, :project_id, :post_id, :private, :project_private, "
+        "setweight(to_tsvector('english', coalesce(:title, '')), 'A') || "
+        "setweight(to_tsvector('english', coalesce(:body, '')), 'B'))"
+    )
+
+    # rank and page first, so the (expensive) headline is only built for the rows that are returned
+    search_statement = (
+        "SELECT project_id, post_id, "
+        "ts_headline('english', coalesce(body, ''), query, "
+        "'StartSel=" + HIGHLIGHT_START + ", StopSel=" + HIGHLIGHT_END + ", MaxWords=35, MinWords=15') AS snippet "
+        "FROM (SELECT project_id, post_id, body, query, ts_rank(document, query) AS rank "
+        "FROM search_index, plainto_tsquery('english', :query) AS query "
+        "WHERE document @@ query AND user_id = :user_id {private_filter} "
+        "ORDER BY rank DESC LIMIT :limit OFFSET :offset) AS ranked "
+        "ORDER BY rank DESC"
+    )
+
+    @staticmethod
+    def make_query(terms):
+        return ' '.join(terms)
+
+
+BACKENDS = {
+    'sqlite': SqliteBackend,
+    'postgresql': PostgresBackend,
+    'postgres': PostgresBackend,
+}
+
+_index_ready = False
+
+
+def get_backend():
+    """Return the search backend for the configured database, or None if search is not available."""
+
+    if not current_app.config.get('SEARCH_ENABLED', True):
+        return None
+
+    scheme = current_app.config['SQLALCHEMY_DATABASE_URI'].split(':', 1)[0].split('+', 1)[0]
+
+    return BACKENDS.get(scheme)
+
+
+def init_app(app):
+
+    @app.before_first_request
+    def create_search_index():
+        try:
+            create_index()
+        except Exception as e:
+            # tried again when the index is first used
+            print('[ERROR]: ', e)
+
+
+def create_index(drop=False):
+    """Create the search index if it does not exist, dropping any existing index first if drop, and return the backend.
+
+    Runs on its own connection to the primary database and commits, so the index is only marked as ready once it
+    really exists.
+
+    """
+
+    global _index_ready
+
+    backend = get_backend()
+    if backend is None:
+        return None
+
+    with db.engine.begin() as connection:
+        if drop:
+            connection.execute(text("DROP TABLE IF EXISTS search_index"))
+        for statement in backend.create_statements:
+            connection.execute(text(statement))
+
+    _index_ready = True
+
+    return backend
+
+
+def _prepare():
+    """Return the search backend, creating the index if that has not been done by this process yet."""
+
+    if not _index_ready:
+        return create_index()
+
+    return get_backend()
+
+
+def _insert(backend, key, user_id, project_id, post_id, private, project_private, title, body):
+    db.session.execute(text("DELETE FROM search_index WHERE %s = :key" % backend.key), {'key': key})
+    db.session.execute(text(backend.insert_statement), {
+        'key': key, 'title': title, 'body': body, 'user_id': user_id, 'project_id': project_id, 'post_id': post_id,
+        'private': private, 'project_private': project_private
+    })
+
+
+def index_project(project):
+    """Add or update the search document of a project, and the project privacy of its posts. Does not commit."""
+
+    backend = _prepare()
+    if backend is None:
+        return
+
+    _insert(backend, project.id * 2, project.user_id, project.id, None, project.private, project.private,
+            project.title, project.body)
+
+    # posts of a private project are hidden from the API, whatever their own privacy
+    db.session.execute(text("UPDATE search_index SET project_private = :private WHERE %s IN %s"
+                            % (backend.key, POST_KEYS)), {'private': project.private, 'project_id': project.id})
+
+
+def index_post(post):
+    """Add or update the search document of a post. Does not commit."""
+
+    backend = _prepare()
+    if backend is None:
+        return
+
+    _insert(backend, post.id * 2 + 1, post.project.user_id, post.project_id, post.post_id, post.private,
+            post.project.private, None, post.body)
+
+
+def remove_project(project_id):
+    """Remove the search documents of a project and all of its posts.
+
+    Must be called before the posts are deleted, as their document keys are looked up from the posts table. Does not
+    commit.
+
+    """
+
+    backend = _prepare()
+    if backend is None:
+        return
+
+    db.session.execute(text("DELETE FROM search_index WHERE %s = :key OR %s IN %s"
+                            % (backend.key, backend.key, POST_KEYS)), {'key': project_id * 2, 'project_id': project_id})
+
+
+def remove_post(project_id, post_id):
+    """Remove the search document of a single post. Must be called before the post is deleted. Does not commit."""
+
+    backend = _prepare()
+    if backend is None:
+        return
+
+    db.session.execute(text("DELETE FROM search_index WHERE %s IN "
+                            "(SELECT id * 2 + 1 FROM posts WHERE project_id = :project_id AND post_id = :post_id)"
+                            % backend.key), {'project_id': project_id, 'post_id': post_id})
+
+
+def rebuild(batch_size=1000):
+    """Drop and rebuild the whole search index from the projects and posts tables, returning the number of documents."""
+
+    if get_backend() is None:
+        return 0
+
+    create_index(drop=True)
+
+    count = 0
+    for project in Project.query.filter_by(deleted=None).yield_per(batch_size):
+        index_project(project)
+        count += 1
+
+    posts = Post.query.join(Project).options(contains_eager(Post.project)).filter(Project.deleted == None)
+    for post in posts.yield_per(batch_size):
+        index_post(post)
+        count += 1
+
+    db.session.commit()
+
+    return count
+
+
+def format_snippet(snippet):
+    """Escape a snippet for html, wrapping the matched terms in <mark> tags."""
+
+    escaped = escape(snippet or '')
+
+    return Markup(escaped.replace(HIGHLIGHT_START, Markup('<mark>')).replace(HIGHLIGHT_END, Markup('</mark>')))
+
+
+def search(user_id, query, limit=20, offset=0, include_private=True):
+    """Return a page of ranked search results for a users projects and posts, best match first.
+
+    Each result is a dict with the `type` ('project' or 'post') of the match, the `name` and `title` of the project,
+    the `post_id` for posts, and a highlighted html `snippet`. Returns None if search is not available.
+
+    """
+
+    backend = _prepare()
+    if backend is None:
+        return None
+
+    terms = re.findall(r'\w+', query or '', re.UNICODE)
+    if not terms:
+        return []
+
+    private_filter = '' if include_private else 'AND private = :private AND project_private = :private'
+    statement = text(backend.search_statement.format(private_filter=private_filter))
+    rows = db.session.execute(statement, {
+        'query': backend.make_query(terms), 'user_id': user_id, 'private': False, 'limit': limit, 'offset': offset
+    }).fetchall()
+
+    # look up the names and titles of all the matched projects at once
+    project_ids = set(int(row.project_id) for row in rows)
+    projects = {}
+    if project_ids:
+        projects = {project_id: (name, title) for project_id, name, title in
+                    db.session.query(Project.id, Project.name, Project.title).filter(Project.id.in_(project_ids))}
+
+    results = []
+    for row in rows:
+        name, title = projects.get(int(row.project_id), (None, None))
+        if name is None:
+            # project was deleted while the search ran
+            continue
+        results.append({
+            'type': 'project' if row.post_id is None else 'post',
+            'name': name,
+            'title': title,
+            'post_id': row.post_id,
+            'snippet': format_snippet(row.snippet),
+        })
+
+    return results
@@ -0,0 +1,186 @@
+import datetime
+import json
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from flask import current_app, g, has_request_context
+
+from projects import db, search
+from projects.helpers import render_markdown
+from projects.models import Job, Project, Post
+
+
+"""
+
+Background tasks
+========================
+
+    Work derived from a change, such as rendering html and updating the search index, runs as a background job so
+    the editor gets their redirect without waiting for it. Routes call `enqueue` in the same transaction as the change,
+    so a job exists exactly when its change was committed, and jobs survive restarts in the `jobs` table.
+
+    Jobs are run by a thread pool of TASK_WORKERS threads in each web process (unless TASKS_IN_PROCESS is False),
+    started after a request that enqueued jobs, and by any number of standalone workers started with scripts/worker.py.
+    Workers claim a job by switching it from pending to running with a conditional update, so each job is run by one
+    worker at a time. Failed jobs are retried after TASK_RETRY_DELAY seconds, doubling each time, up to
+    TASK_MAX_ATTEMPTS attempts. Jobs left running for longer than TASK_TIMEOUT seconds, e.g. by a worker that was
+    killed, are made pending again.
+
+    Until a project or post's html job has run, its body is rendered when it is displayed (see helpers.format_body).
+
+"""
+
+PENDING = 'pending'
+RUNNING = 'running'
+FAILED = 'failed'
+
+TASKS = {}
+
+
+def task(function):
+    """Decorator registering function as a task that jobs can run, under its own name."""
+
+    TASKS[function.__name__] = function
+    return function
+
+
+def enqueue(name, delay=0, **kwargs):
+    """Add a job running the task name with kwargs, due in delay seconds. Does not commit."""
+
+    now = datetime.datetime.now()
+    db.session.add(Job(name=name, args=json.dumps(kwargs), status=PENDING, attempts=0,
+                       run_at=now + datetime.timedelta(seconds=delay), created=now))
+
+    if has_request_context():
+        g.tasks_enqueued = True
+
+
+def reclaim_stale_jobs():
+    """Make jobs that have been running for longer than TASK_TIMEOUT pending again, returning how many there were."""
+
+    timeout = datetime.timedelta(seconds=current_app.config.get('TASK_TIMEOUT', 300))
+    count = Job.query.filter(Job.status == RUNNING, Job.locked_at < datetime.datetime.now() - timeout).update(
+        {'status': PENDING}, synchronize_session=False)
+    db.session.commit()
+
+    return count
+
+
+def run_next_job():
+    """Claim and run the next due job. Returns False if there were no due jobs."""
+
+    now = datetime.datetime.now()
+    job = db.session.query(Job.id, Job.name, Job.args, Job.attempts).filter(
+        Job.status == PENDING, Job.run_at <= now).order_by(Job.run_at, Job.id).first()
+    if job is None:
+        db.session.rollback()
+        return False
+
+    claimed = Job.query.filter_by(id=job.id, status=PENDING).update(
+        {'status': RUNNING, 'locked_at': now, 'attempts': Job.attempts + 1}, synchronize_session=False)
+    db.session.commit()
+    if not claimed:
+        # another worker got to it first
+        return True
+
+    try:
+        TASKS[job.name](**json.loads(job.args))
+        db.session.commit()
+    except Exception as e:
+        print('[ERROR]: ', e)
+        db.session.rollback()
+        fail_job(job.id, job.attempts + 1, traceback.format_exc())
+    else:
+        Job.query.filter_by(id=job.id).delete(synchronize_session=False)
+        db.session.commit()
+
+    return True
+
+
+def fail_job(job_id, attempts, error):
+    """Schedule a retry of a failed job, or mark it failed if it has run out of attempts."""
+
+    if attempts >= current_app.config.get('TASK_MAX_ATTEMPTS', 5):
+        values = {'status': FAILED}
+    else:
+        delay = current_app.config.get('TASK_RETRY_DELAY', 10) * 2 ** (attempts - 1)
+        values = {'status': PENDING, 'run_at': datetime.datetime.now() + datetime.timedelta(seconds=delay)}
+
+    values['last_error'] = error
+    Job.query.filter_by(id=job_id).update(values, synchronize_session=False)
+    db.session.commit()
+
+
+def run_pending_jobs():
+    """Run jobs until none are due, returning the number of jobs run."""
+
+    reclaim_stale_jobs()
+
+    count = 0
+    while run_next_job():
+        count += 1
+
+    return count
+
+
+def init_app(app):
+    if not app.config.get('TASKS_IN_PROCESS', True):
+        return
+
+    # threads are only started on the first submit, so this is safe to create before uWSGI forks its workers
+    executor = ThreadPoolExecutor(max_workers=app.config.get('TASK_WORKERS', 2))
+
+    def run_in_background():
+        with app.app_context():
+            try:
+                run_pending_jobs()
+            except Exception as e:
+                print('[ERROR]: ', e)
+            finally:
+                db.session.remove()
+
+    @app.after_request
+    def start_jobs(response):
+        if g.get('tasks_enqueued'):
+            executor.submit(run_in_background)
+        return response
+
+
+# ---------------- tasks ---------------- #
+
+
+@task
+def update_project(project_id):
+    """Render the html body of a project and update its search document."""
+
+    project = Project.query.filter_by(id=project_id, deleted=None).first()
+    if project is None:
+        return
+
+    # only store the html if the body was not edited again since it was read, a later job renders the new body
+    updated = Project.query.filter_by(id=project_id, body=project.body).update(
+        {'body_html': render_markdown(project.body)}, synchronize_session=False)
+    if updated:
+        search.index_project(project)
+
+
+@task
+def update_post(post_id):
+    """Render the html body of a post and update its search document."""
+
+    post = Post.query.join(Project).filter(Post.id == post_id, Project.deleted == None).first()
+    if post is None:
+        return
+
+    # only store the html if the body was not edited again since it was read, a later job renders the new body
+    updated = Post.query.filter_by(id=post_id, body=post.body).update(
+        {'body_html': render_markdown(post.body)}, synchronize_session=False)
+    if updated:
+        search.index_post(post)
+
+
+@task
+def purge_project(project_id):
+    """Purge the rows of a soft deleted project, see Project.purge_project."""
+
+    Project.purge_project(project_id, batch_size=current_app.config.get('DELETE_BATCH_SIZE', 1000))
@@ -1,19 +1,31 @@
-from flask import redirect, render_template, abort, request, url_for, flash
+from flask import Blueprint, redirect, render_template, abort, request, url_for, flash, current_app
 from flask_login import login_user, logout_user, current_user
 from flask_login import login_required
 
 import datetime
 
-from sqlalchemy import desc
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import undefer
 
-from projects import app, db
+from projects import changes, db, feeds, fragments, search, tasks
+from projects.auth import LoginThrottled, allow_login_attempt, check_password, end_sessions
 from projects.forms import LoginForm, EditProjectForm, EditPostForm
+from projects.helpers import conditional
 from projects.models import User, Project, Post
+from projects.replicas import read_only
 
 
-@app.login_manager.user_loader
-def load_user(user_id):
-    return User.query.get(int(user_id))
+blueprint = Blueprint('web', __name__)
+
+
+def project_list_version():
+    """Version of the current users project listing, for conditional requests."""
+    return Project.get_list_version(current_user.id)
+
+
+def project_version(project_name, **kwargs):
+    """Version of a project of the current user and its posts, for conditional requests."""
+    return Project.get_version(current_user.id, project_name)
 
 
 """
@@ -22,7 +34,7 @@ Routes for web interface
 ========================
 
     - index: main page with all projects listed
-    - login/logout: routes for logging in and out
+    - login/logout: routes for logging in and out, and logout/all for ending all sessions of the user
     - project/<project_name>: each project gets a single page, where names's are random strings (see below)
     - project/<project_name>/post/<post_id>: each project gets unlimited posts
 
@@ -39,42 +51,67 @@ Routes for web interface
 #######
 
 
-@app.route('/login', methods=['GET', 'POST'])
+@blueprint.route('/login', methods=['GET', 'POST'])
 def login():
     """Route for logging in."""
 
     if not current_user.is_anonymous:
         # user is already logged in so we redirect to index
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
 
     form = LoginForm()
     if form.validate_on_submit():
+        if not allow_login_attempt(request.remote_addr, form.username.data):
+            flash('Too many login attempts, try again later', 'danger')
+            return render_template('login.html', form=form), 429
+
         # login attempted, try to get user data, confirm password, then login
-        user = User.query.filter_by(username=form.username.data).limit(1).first()
+        user = User.query.options(undefer('password')).filter_by(username=form.username.data).limit(1).first()
         if user is not None:
-            if user.password == form.password.data:
+            try:
+                valid = check_password(user, form.password.data)
+            except LoginThrottled:
+                flash('Too many login attempts, try again later', 'danger')
+                return render_template('login.html', form=form), 429
+
+            if valid:
+                # store the hash if it was upgraded
+                db.session.commit()
                 login_user(user)
                 # redirect to next if specified, else index
-                return redirect(request.args.get('next') or url_for('index'))
+                return redirect(request.args.get('next') or url_for('.index'))
 
             else:
                 # password does not match
                 flash('Invalid password', 'danger')
-                return redirect(url_for('login'))
+                return redirect(url_for('.login'))
         else:
             # username does not exist
             flash('Invalid username', 'danger')
-            return redirect(url_for('login'))
+            return redirect(url_for('.login'))
 
     return render_template('login.html', form=form)
 
 
-@app.route('/logout')
+@blueprint.route('/logout')
 @login_required
 def logout():
     """Route for logging out."""
     logout_user()
-    return redirect(url_for('index'))
+    return redirect(url_for('.index'))
+
+
+@blueprint.route('/logout/all')
+@login_required
+def logout_all():
+    """Route for logging out of all sessions, e.g. on other devices."""
+
+    user = User.query.get(current_user.id)
+    end_sessions(user)
+    db.session.commit()
+
+    logout_user()
+    return redirect(url_for('.index'))
 
 ########
 #
@@ -83,52 +120,95 @@ def logout():
 #######
 
 
-@app.route('/', methods=['GET'])
-@app.route('/index', methods=['GET'])
+@blueprint.route('/', methods=['GET'])
+@blueprint.route('/index', methods=['GET'])
+@read_only
 @login_required
+@conditional(project_list_version)
 def index():
-    """Displays page summaries sorted by date created in descending order."""
+    """Displays page summaries sorted by date created in descending order, a page at a time."""
 
-    projects = Project.query.filter_by(user_id=current_user.id).order_by(desc(Project.created)).all()
-    return render_template('index.html', projects=projects)
+    try:
+        projects, next_cursor = Project.get_page(current_user.id, cursor=request.args.get('cursor'),
+                                                 limit=current_app.config.get('PROJECTS_PER_PAGE', 20))
+    except ValueError:
+        abort(400)
 
+    return render_template('index.html', projects=projects, next_cursor=next_cursor)
 
-@app.route('/project/<project_name>', methods=['GET'])
+
+@blueprint.route('/project/<project_name>', methods=['GET'])
+@read_only
 @login_required
+@conditional(project_version)
 def view_project(project_name):
     """Default route for viewing a project and its most recent post if it exists."""
 
     # None if no page with page_name exists
-    project = Project.query.filter_by(user_id=current_user.id, name=project_name).first()
-    posts = [post for post in project.posts]
-
-    if len(posts) > 1:
-        # get most recent post by default
-        post = posts[-1]
-    else:
-        post = None
+    project = Project.query.filter_by(user_id=current_user.id, name=project_name, deleted=None).first()
 
     if project is None:
         # if project is None then the page doesn't exist so we abort
         abort(404)
-    return render_template('viewer.html', project=project, posts=posts, post=post)
+
+    # get most recent post by default, None if the project has no posts
+    post = project.get_latest_post()
+
+    older_id, newer_id = None, None
+    if post is not None:
+        older_id, newer_id = project.get_post_neighbours(post.post_id)
+
+    return render_template('viewer.html', project=project, post=post, older_id=older_id, newer_id=newer_id)
 
 
-@app.route('/project/<project_name>/post/<int:post_id>', methods=['GET'])
+@blueprint.route('/project/<project_name>/post/<int:post_id>', methods=['GET'])
+@read_only
 @login_required
+@conditional(project_version)
 def view_post(project_name, post_id):
     """Route for viewing a specific post belonging to a page."""
 
     # None if no page with page_name exists
-    project = Project.query.filter_by(user_id=current_user.id, name=project_name).first()
-    post = project.posts.filter_by(post_id=post_id).first()
+    project = Project.query.filter_by(user_id=current_user.id, name=project_name, deleted=None).first()
+    post = project.posts.filter_by(post_id=post_id).first() if project is not None else None
 
     if project is None or post is None:
         # Abort if page_data or post_data are None; occurs when the page_name does not exist, or when the
         # post_id does not exist for that page_name.
         abort(404)
 
-    return render_template('viewer.html', project=project, post=post)
+    older_id, newer_id = project.get_post_neighbours(post.post_id)
+
+    return render_template('viewer.html', project=project, post=post, older_id=older_id, newer_id=newer_id)
+
+@blueprint.route('/search', methods=['GET'])
+@read_only
+@login_required
+def search_page():
+    """Displays a page of search results for projects and posts, best match first."""
+
+    query = request.args.get('q', '')
+    per_page = current_app.config.get('SEARCH_RESULTS_PER_PAGE', 20)
+
+    try:
+        page = max(int(request.args.get('page', 1)), 1)
+    except ValueError:
+        abort(400)
+
+    offset = (page - 1) * per_page
+    if offset >= current_app.config.get('SEARCH_MAX_RESULTS', 1000):
+        # deep pages of ranked results are expensive and not useful, so they are not served
+        abort(404)
+
+    # fetch one extra result to find out whether there is a following page
+    results = search.search(current_user.id, query, limit=per_page + 1, offset=offset)
+    if results is None:
+        # search is not available for the configured database
+        abort(404)
+
+    next_page = page + 1 if len(results) > per_page else None
+
+    return render_template('search.html', query=query, results=results[:per_page], page=page, next_page=next_page)
 
 ########
 #
@@ -137,7 +217,7 @@ def view_post(project_name, post_id):
 #######
 
 
-@app.route('/project/new', methods=['GET', 'POST'])
+@blueprint.route('/project/new', methods=['GET', 'POST'])
 @login_required
 def new_project():
     """Route for creating a new project."""
@@ -147,35 +227,50 @@ def new_project():
     if form.validate_on_submit() and request.method == 'POST':
 
         try:
-            project = Project(
-                name=Project.generate_page_name(),
-                title=form.title.data,
-                body=form.body.data,
-                created=datetime.datetime.now(),
-                private=form.private.data,
-                user=current_user
-            )
-            db.session.add(project)
-            db.session.commit()
 
-            return redirect(url_for('view_project', project_name=project.name))
+            for attempt in range(current_app.config.get('PAGE_NAME_RETRIES', 3)):
+                try:
+                    created = datetime.datetime.now()
+                    project = Project(
+                        name=Project.generate_page_name(),
+                        title=form.title.data,
+                        body=form.body.data,
+                        created=created,
+                        modified=created,
+                        private=form.private.data,
+                        user_id=current_user.id
+                    )
+                    db.session.add(project)
+                    db.session.flush()
+                    # html and search document are made in the background
+                    tasks.enqueue('update_project', project_id=project.id)
+                    db.session.commit()
+                    break
+
+                except IntegrityError:
+                    # name was taken by a concurrent request since it was generated
+                    db.session.rollback()
+            else:
+                raise RuntimeError('Could not allocate a name for the new project')
+
+            return redirect(url_for('.view_project', project_name=project.name))
 
         except Exception as e:
             print('[ERROR]: ', e)
             # TODO handle this error better
-            return redirect(url_for('index'))
+            return redirect(url_for('.index'))
 
     # Render without any page content to auto fill editor with as we're creating a new project
     return render_template('editor.html', form=form, type_='project', new=True, data=None)
 
 
-@app.route('/project/<project_name>/post/new', methods=['GET', 'POST'])
+@blueprint.route('/project/<project_name>/post/new', methods=['GET', 'POST'])
 @login_required
 def new_post(project_name):
     """Route for creating a new post."""
 
     # None if no page with page_name exists
-    project = Project.query.filter_by(user_id=current_user.id, name=project_name).first()
+    project = Project.query.filter_by(user_id=current_user.id, name=project_name, deleted=None).first()
 
     if project is None:
         # if page_data is None then the page doesn't exist in the database so we abort
@@ -186,25 +281,41 @@ def new_post(project_name):
     if form.validate_on_submit() and request.method == 'POST':
         try:
 
-            num_posts = len([post for post in project.posts])
-
-            post = Post(
-                post_id=num_posts + 1,  # need a better way of doing this as it is prone to break
-                title=project.title,  # posts get their title from the project
-                body=form.body.data,
-                created=datetime.datetime.now(),
-                private=form.private.data,
-                project=project
-            )
-            db.session.add(post)
-            db.session.commit()
+            for attempt in range(current_app.config.get('POST_ID_RETRIES', 3)):
+                try:
+                    created = datetime.datetime.now()
+                    post = Post(
+                        post_id=Project.allocate_post_id(project.id),
+                        title=project.title,  # posts get their title from the project
+                        body=form.body.data,
+                        created=created,
+                        modified=created,
+                        private=form.private.data,
+                        project=project,
+                        user_id=project.user_id
+                    )
+                    db.session.add(post)
+                    db.session.flush()
+                    # html and search document are made in the background
+                    tasks.enqueue('update_post', post_id=post.id)
+                    db.session.commit()
+                    break
+
+                except IntegrityError:
+                    # post_id already taken, e.g. the counter is behind posts created before it existed
+                    db.session.rollback()
+                    Project.resync_post_id(project.id)
+            else:
+                raise RuntimeError('Could not allocate a post_id for project %s' % project.name)
+
+            feeds.invalidate(project_name)
 
-            return redirect(url_for('view_post', project_name=post.project.name, post_id=post.id))
+            return redirect(url_for('.view_post', project_name=project.name, post_id=post.post_id))
 
         except Exception as e:
             print('[ERROR]: ', e)
             # TODO handle this error better
-            return redirect(url_for('index'))
+            return redirect(url_for('.index'))
 
     # Render without any page content to auto fill editor with as we're creating a new post
     return render_template('editor.html', form=form, type_='post', new=True, data=project)
@@ -217,13 +328,13 @@ def new_post(project_name):
 #######
 
 
-@app.route('/project/<project_name>/edit', methods=['GET', 'POST'])
+@blueprint.route('/project/<project_name>/edit', methods=['GET', 'POST'])
 @login_required
 def edit_project(project_name):
     """Route for editing an existing project."""
 
     # None if no page with page_name exists
-    project = Project.query.filter_by(user_id=current_user.id, name=project_name).first()
+    project = Project.query.filter_by(user_id=current_user.id, name=project_name, deleted=None).first()
 
     if project is None:
         # if project is None then the project doesn't exist in the database so we abort
@@ -234,31 +345,43 @@ def edit_project(project_name):
 
     if form.validate_on_submit() and request.method == 'POST':
         try:
+            privacy_changed = project.private != form.private.data
+
             project.title = form.title.data
             project.body = form.body.data
-            project.edited = datetime.datetime.now()
+            # shown rendered on the fly until the background job renders it again
+            project.body_html = None
+            project.edited = project.modified = datetime.datetime.now()
             project.private = form.private.data
 
+            if privacy_changed:
+                # search must stop showing a project made private right away, not once the job has run
+                search.index_project(project)
+                # the visibility of its posts changed too, so they are sent to API clients following the change feed
+                Project.mark_posts_modified(project.id, project.modified)
+            tasks.enqueue('update_project', project_id=project.id)
             db.session.commit()
+            fragments.invalidate('project-panel', project.id)
+            feeds.invalidate(project_name)
 
-            return redirect(url_for('view_project', project_name=project.name))
+            return redirect(url_for('.view_project', project_name=project.name))
 
         except Exception as e:
             print('[ERROR]: ', e)
             # TODO handle this error better
-            return redirect(url_for('index'))
+            return redirect(url_for('.index'))
 
     return render_template('editor.html', form=form, type_='project', new=False, data=project)
 
 
-@app.route('/project/<project_name>/post/<int:post_id>/edit', methods=['GET', 'POST'])
+@blueprint.route('/project/<project_name>/post/<int:post_id>/edit', methods=['GET', 'POST'])
 @login_required
 def edit_post(project_name, post_id):
     """Route for editing an existing post."""
 
     # None if no page with page_name exists
-    project = Project.query.filter_by(user_id=current_user.id, name=project_name).first()
-    post = project.posts.filter_by(post_id=post_id).first()
+    project = Project.query.filter_by(user_id=current_user.id, name=project_name, deleted=None).first()
+    post = project.posts.filter_by(post_id=post_id).first() if project is not None else None
 
     if project is None or post is None:
         # Abort if project or post_data are None; occurs when the page_name does not exist, or when the
@@ -270,18 +393,27 @@ def edit_post(project_name, post_id):
 
     if form.validate_on_submit() and request.method == 'POST':
         try:
+            privacy_changed = post.private != form.private.data
+
             post.body = form.body.data
-            post.edited = datetime.datetime.now()
+            # shown rendered on the fly until the background job renders it again
+            post.body_html = None
+            post.edited = post.modified = datetime.datetime.now()
             post.private = form.private.data
 
+            if privacy_changed:
+                # search must stop showing a post made private right away, not once the job has run
+                search.index_post(post)
+            tasks.enqueue('update_post', post_id=post.id)
             db.session.commit()
+            feeds.invalidate(project_name)
 
-            return redirect(url_for('view_post', project_name=project.name, post_id=post.id))
+            return redirect(url_for('.view_post', project_name=project.name, post_id=post.post_id))
 
         except Exception as e:
             print('[ERROR]: ', e)
             # TODO handle this error better
-            return redirect(url_for('index'))
+            return redirect(url_for('.index'))
 
     return render_template('editor.html', form=form, type_='post', new=False, data=post)
 
@@ -291,47 +423,67 @@ def edit_post(project_name, post_id):
 #
 #######
 
-@app.route('/project/<project_name>/delete', methods=['GET'])
+@blueprint.route('/project/<project_name>/delete', methods=['GET', 'POST'])
 @login_required
 def delete_page(project_name):
     """Delete page from the database.
 
-    NOTE: will delete all associated posts as well.
+    NOTE: will delete all associated posts as well. If DEFERRED_DELETE is set the project is hidden immediately and
+    its rows are purged by a background job instead.
 
     """
 
     # None if no page with page_name exists
-    project = Project.query.filter_by(user_id=current_user.id, name=project_name).first()
+    project = Project.query.filter_by(user_id=current_user.id, name=project_name, deleted=None).first()
 
     if project is None:
         # Abort if project or are None; occurs when the page_name does not exist, or when the
         # post_id does not exist for that page_name.
         abort(404)
 
-    # delete posts for the project first
-    for post in project.posts:
-        Post.query.filter_by(id=post.id).delete()
+    search.remove_project(project.id)
+    fragments.invalidate('project-panel', project.id)
+    changes.add_tombstone(current_user.id, project.name)
 
-    Project.query.filter_by(user_id=current_user.id, name=project_name).delete()
+    if current_app.config.get('DEFERRED_DELETE', False):
+        project.deleted = datetime.datetime.now()
+        tasks.enqueue('purge_project', project_id=project.id)
+        db.session.commit()
+    else:
+        Project.delete_project(project.id)
+        db.session.commit()
 
-    db.session.commit()
+    feeds.invalidate(project_name)
 
-    return redirect(url_for('index'))
+    return redirect(url_for('.index'))
 
 
-@app.route('/delete/post', methods=['POST'])
+@blueprint.route('/delete/post', methods=['POST'])
 @login_required
 def delete_post():
     """Delete post from the database."""
 
     try:
         page_name = request.form['page_name']
-        post_id = request.form['post_id']
+        post_id = int(request.form['post_id'])
     except Exception as e:
         print(e)
-        return redirect(url_for('index'))
+        return redirect(url_for('.index'))
 
     # None if no page with page_name exists
-    page_data, post_data = Post.delete_post(page_name=page_name, post_id=post_id)
+    project = Project.query.filter_by(user_id=current_user.id, name=page_name, deleted=None).first()
+
+    if project is None:
+        abort(404)
+
+    search.remove_post(project.id, post_id)
+
+    if Post.delete_post(project.id, post_id) == 0:
+        # post_id does not exist for that page_name
+        abort(404)
+
+    changes.add_tombstone(current_user.id, project.name, post_id)
+    db.session.commit()
+    feeds.invalidate(page_name)
 
-    return redirect(url_for('index'))
+    return redirect(url_for('.view_project', project_name=project.name))
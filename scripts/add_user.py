@@ -5,7 +5,7 @@ from sqlalchemy.exc import IntegrityError
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
-from projects import db
+from projects import create_app, db
 from projects.models import User
 
 
@@ -31,4 +31,5 @@ def add_user():
     return
 
 if __name__ == '__main__':
-    add_user()
+    with create_app().app_context():
+        add_user()
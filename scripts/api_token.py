@@ -0,0 +1,47 @@
+import sys
+import os
+from argparse import ArgumentParser
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from projects import create_app, db
+from projects.auth import generate_api_token, revoke_api_token
+from projects.models import User
+
+
+def api_token():
+    """Issue, rotate or revoke the API token of a user."""
+
+    parser = ArgumentParser()
+    parser.add_argument("action", choices=['issue', 'rotate', 'revoke'],
+                        help="issue a token for a user without one, replace an existing token, or remove it")
+    parser.add_argument("-u", "--username", dest="username", help="user to manage the token of", required=True)
+
+    args = parser.parse_args()
+
+    user = User.query.filter_by(username=args.username).first()
+    if user is None:
+        print('[ERROR] User with username %s does not exist.' % args.username)
+        return
+
+    if args.action == 'issue' and user.api_token_id is not None:
+        print('[ERROR] User %s already has an API token, use rotate to replace it.' % args.username)
+        return
+
+    if args.action == 'revoke':
+        revoke_api_token(user)
+        db.session.commit()
+        print('[INFO] Revoked API token of user %s.' % args.username)
+        return
+
+    token = generate_api_token(user)
+    db.session.commit()
+
+    # only a digest is stored, so this is the only time the token can be shown
+    print(token)
+
+    return
+
+if __name__ == '__main__':
+    with create_app().app_context():
+        api_token()
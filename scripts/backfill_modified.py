@@ -0,0 +1,33 @@
+import sys
+import os
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import func
+
+from projects import create_app, db
+from projects.models import Project, Post
+
+
+def backfill_modified():
+    """Fill in the columns the API change feed needs for existing rows: modification times and the owners of posts."""
+
+    for model in (Project, Post):
+        count = model.query.filter(model.modified.is_(None)).update(
+            {'modified': func.coalesce(model.edited, model.created)}, synchronize_session=False)
+        db.session.commit()
+
+        print('[INFO] Set modification time of %d rows in %s table.' % (count, model.__tablename__))
+
+    # posts are found by their owner in the change feed too
+    owner = db.session.query(Project.user_id).filter(Project.id == Post.project_id).as_scalar()
+    count = Post.query.filter(Post.user_id.is_(None)).update({'user_id': owner}, synchronize_session=False)
+    db.session.commit()
+
+    print('[INFO] Set owner of %d rows in posts table.' % count)
+
+    return
+
+if __name__ == '__main__':
+    with create_app().app_context():
+        backfill_modified()
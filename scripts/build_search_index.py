@@ -0,0 +1,30 @@
+import sys
+import os
+from argparse import ArgumentParser
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from projects import create_app, search
+
+
+def build_search_index():
+    """Drop and rebuild the full text search index from the projects and posts tables."""
+
+    parser = ArgumentParser()
+    parser.add_argument("-b", "--batch-size", dest="batch_size", type=int, default=1000,
+                        help="number of rows to load from the database at a time")
+
+    args = parser.parse_args()
+
+    if search.get_backend() is None:
+        print('[ERROR] Search is disabled or not supported by the configured database.')
+        return
+
+    count = search.rebuild(batch_size=args.batch_size)
+    print('[INFO] Indexed %d projects and posts.' % count)
+
+    return
+
+if __name__ == '__main__':
+    with create_app().app_context():
+        build_search_index()
@@ -0,0 +1,49 @@
+import sys
+import os
+from argparse import ArgumentParser
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from projects import create_app
+from projects.export import export_records
+from projects.helpers import parse_timestamp
+from projects.models import User
+
+
+def export():
+    """Export projects and posts as newline delimited JSON."""
+
+    parser = ArgumentParser()
+    parser.add_argument("-o", "--output", dest="output", help="file to write to, defaults to stdout")
+    parser.add_argument("-u", "--username", dest="username", help="only export projects of this user")
+    parser.add_argument("-s", "--since", dest="since", type=parse_timestamp,
+                        help="only export projects and posts created or edited since this ISO 8601 timestamp")
+    parser.add_argument("--public-only", dest="public_only", action="store_true",
+                        help="leave out private projects and posts")
+    parser.add_argument("-b", "--batch-size", dest="batch_size", type=int, default=1000,
+                        help="number of rows to fetch from the database at a time")
+
+    args = parser.parse_args()
+
+    user_id = None
+    if args.username is not None:
+        user = User.query.filter_by(username=args.username).first()
+        if user is None:
+            print('[ERROR] User with username %s does not exist.' % args.username, file=sys.stderr)
+            return
+        user_id = user.id
+
+    output = open(args.output, 'w') if args.output else sys.stdout
+    try:
+        for line in export_records(user_id=user_id, since=args.since, include_private=not args.public_only,
+                                   batch_size=args.batch_size):
+            output.write(line)
+    finally:
+        if output is not sys.stdout:
+            output.close()
+
+    return
+
+if __name__ == '__main__':
+    with create_app().app_context():
+        export()
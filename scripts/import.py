@@ -0,0 +1,332 @@
+"""
+Bulk import of projects and posts.
+
+Reads either a newline delimited JSON file in the format written by scripts/export.py, or a directory of markdown
+files laid out as:
+
+    <directory>/<project>.md             a project with no posts
+    <directory>/<project>/index.md       the body of a project (optional)
+    <directory>/<project>/<post>.md      posts of the project, numbered in file name order
+
+The title of a project made from markdown is its first '# ' heading, or its file/directory name. Files are read in
+name order.
+
+Rows are written with batched executemany inserts and committed every --chunk-size rows. Page names are checked and
+reserved a chunk at a time. Post numbers are taken from the export, or allocated in memory for posts added to
+existing projects, and each projects next_post_id counter is brought up to date once the import has finished. The
+import is meant to run while the site is not taking posts for the projects being imported into.
+
+The search index is not updated; run scripts/build_search_index.py afterwards.
+"""
+
+import sys
+import os
+import datetime
+import json
+import time
+from argparse import ArgumentParser
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from sqlalchemy import bindparam, func
+
+from projects import create_app, db
+from projects.helpers import parse_timestamp, render_markdown
+from projects.models import User, Project, Post
+
+
+# largest number of values put in a single IN clause, kept below the bound parameter limits of the databases
+IN_CHUNK_SIZE = 500
+
+
+def read_ndjson(path):
+    """Generate the records of an NDJSON export file."""
+
+    with open(path) as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                print('[WARNING] Skipping line %d, it is not valid JSON.' % line_number, file=sys.stderr)
+                continue
+            for key in ('created', 'edited'):
+                if record.get(key):
+                    record[key] = parse_timestamp(record[key])
+            yield record
+
+
+def read_markdown_file(path):
+    """Return (title, body, modified) of a markdown file."""
+
+    with open(path) as f:
+        body = f.read()
+
+    title = None
+    for line in body.splitlines():
+        if line.startswith('# '):
+            title = line[2:].strip()
+            break
+
+    return title, body, datetime.datetime.fromtimestamp(os.path.getmtime(path))
+
+
+def read_markdown_directory(path):
+    """Generate project and post records from a directory of markdown files."""
+
+    for entry in sorted(os.listdir(path)):
+        entry_path = os.path.join(path, entry)
+        name, extension = os.path.splitext(entry)
+
+        if os.path.isfile(entry_path) and extension == '.md':
+            title, body, modified = read_markdown_file(entry_path)
+            yield {'type': 'project', 'name': None, 'key': entry, 'title': title or name, 'body': body,
+                   'created': modified, 'private': True}
+
+        elif os.path.isdir(entry_path):
+            index_path = os.path.join(entry_path, 'index.md')
+            title, body, modified = None, None, datetime.datetime.fromtimestamp(os.path.getmtime(entry_path))
+            if os.path.isfile(index_path):
+                title, body, modified = read_markdown_file(index_path)
+            yield {'type': 'project', 'name': None, 'key': entry, 'title': title or entry, 'body': body,
+                   'created': modified, 'private': True}
+
+            for post_file in sorted(os.listdir(entry_path)):
+                post_path = os.path.join(entry_path, post_file)
+                if post_file == 'index.md' or not post_file.endswith('.md') or not os.path.isfile(post_path):
+                    continue
+                _, body, modified = read_markdown_file(post_path)
+                yield {'type': 'post', 'project': entry, 'body': body, 'created': modified, 'private': True}
+
+
+class Importer(object):
+    """Buffers imported rows and writes them to the database in chunks."""
+
+    def __init__(self, user_id=None, chunk_size=1000, render_html=True):
+        self.user_id = user_id
+        self.chunk_size = chunk_size
+        self.render_html = render_html
+
+        # usernames to user ids, for NDJSON records
+        self.user_ids = {username: id_ for id_, username in db.session.query(User.id, User.username)}
+        # page names given to projects by this import
+        self.used_names = set()
+
+        # record key to [project id, project title, next post_id, created by this import, user id], for every
+        # project posts may be added to; the id is None until the project is written
+        self.projects = {}
+        self.pending_projects = []
+        self.pending_posts = []
+        # (project, row) of posts whose project is still pending, given their project id once it is written
+        self.waiting_posts = []
+
+        self.inserted = 0
+        self.skipped = 0
+        self.started = time.time()
+
+    def add(self, record):
+        if record.get('type') == 'project':
+            self.add_project(record)
+        elif record.get('type') == 'post':
+            self.add_post(record)
+        else:
+            self.skip('record has no valid type')
+
+    def skip(self, reason):
+        self.skipped += 1
+        print('[WARNING] Skipping record, %s.' % reason, file=sys.stderr)
+
+    def add_project(self, record):
+        user_id = self.user_id or self.user_ids.get(record.get('user'))
+        if user_id is None:
+            return self.skip('user %s does not exist' % record.get('user'))
+
+        key = record.get('key') or record.get('name')
+        if key is None:
+            # no posts can refer to this project, but it still needs its own entry
+            key = ('unnamed', len(self.projects))
+        name = record.get('name')
+        if name is not None and name in self.used_names:
+            # name is taken, so the project gets a new one when the chunk is written
+            name = None
+        if name is not None:
+            self.used_names.add(name)
+
+        project = [None, record.get('title'), 1, True, user_id]
+        self.projects[key] = project
+        self.pending_projects.append((project, {
+            'name': name,
+            'title': record.get('title'),
+            'body': record.get('body'),
+            'body_html': render_markdown(record.get('body')) if self.render_html else None,
+            'created': record.get('created') or datetime.datetime.now(),
+            'edited': record.get('edited'),
+            # new to API clients following the change feed, whenever it was created
+            'modified': datetime.datetime.now(),
+            'private': record.get('private', True),
+            'next_post_id': 1,
+            'user_id': user_id,
+        }))
+
+        if len(self.pending_projects) >= self.chunk_size:
+            self.flush_projects()
+
+    def add_post(self, record):
+        key = record.get('project')
+        if key not in self.projects:
+            # not added by this import, so it has to have existed before it
+            project = db.session.query(Project.id, Project.title, Project.next_post_id, Project.user_id).filter_by(
+                name=key, deleted=None).first()
+            if project is None:
+                return self.skip('project %s does not exist' % key)
+            self.projects[key] = [project.id, project.title, project.next_post_id, False, project.user_id]
+
+        project = self.projects[key]
+        post_id = project[2]
+        if project[3] and record.get('post_id'):
+            # keep the exported numbering of projects this import created
+            post_id = record['post_id']
+        project[2] = max(project[2], post_id + 1)
+
+        row = {
+            'post_id': post_id,
+            'title': project[1],
+            'body': record.get('body'),
+            'body_html': render_markdown(record.get('body')) if self.render_html else None,
+            'created': record.get('created') or datetime.datetime.now(),
+            'edited': record.get('edited'),
+            'modified': datetime.datetime.now(),
+            'private': record.get('private', True),
+            'project_id': project[0],
+            'user_id': project[4],
+        }
+        if project[0] is None:
+            self.waiting_posts.append((project, row))
+        else:
+            self.pending_posts.append(row)
+
+        if len(self.pending_posts) + len(self.waiting_posts) >= self.chunk_size:
+            # writes the pending projects first if any of the posts belong to them
+            self.flush_projects()
+            self.flush_posts()
+
+    def flush_projects(self):
+        if not self.pending_projects:
+            return
+
+        # names already in the database are replaced, found with one query for the whole chunk
+        used = Project.find_used_names(row['name'] for _, row in self.pending_projects if row['name'] is not None)
+        for _, row in self.pending_projects:
+            if row['name'] in used:
+                row['name'] = None
+
+        # reserve names for the whole chunk at once
+        unnamed = [row for _, row in self.pending_projects if row['name'] is None]
+        if unnamed:
+            for row, name in zip(unnamed, Project.generate_page_names(len(unnamed), exclude=self.used_names)):
+                row['name'] = name
+                self.used_names.add(name)
+
+        rows = [row for _, row in self.pending_projects]
+        db.session.execute(Project.__table__.insert(), rows)
+
+        # executemany does not return ids, so look them up by their (unique) names
+        names = [row['name'] for row in rows]
+        ids = {}
+        for start in range(0, len(names), IN_CHUNK_SIZE):
+            ids.update(db.session.query(Project.name, Project.id).filter(
+                Project.name.in_(names[start:start + IN_CHUNK_SIZE])))
+        for project, row in self.pending_projects:
+            project[0] = ids[row['name']]
+
+        self.commit(len(rows))
+        self.pending_projects = []
+
+        # the posts of the projects can be written now their ids are known
+        for project, row in self.waiting_posts:
+            row['project_id'] = project[0]
+            self.pending_posts.append(row)
+        self.waiting_posts = []
+
+    def flush_posts(self):
+        if not self.pending_posts:
+            return
+
+        db.session.execute(Post.__table__.insert(), self.pending_posts)
+
+        self.commit(len(self.pending_posts))
+        self.pending_posts = []
+
+    def commit(self, count):
+        db.session.commit()
+
+        self.inserted += count
+        elapsed = time.time() - self.started
+        # time.time() may not have advanced at all for a small first chunk
+        rate = self.inserted / elapsed if elapsed > 0 else 0
+        print('[INFO] %d rows imported in %.1fs (%.0f rows/s).' % (self.inserted, elapsed, rate), file=sys.stderr)
+
+    def finish(self):
+        self.flush_projects()
+        self.flush_posts()
+
+        # bring the post_id counters of every project posts were added to up to date, a chunk of projects at a time
+        project_ids = [project[0] for project in self.projects.values()]
+        for start in range(0, len(project_ids), IN_CHUNK_SIZE):
+            chunk = project_ids[start:start + IN_CHUNK_SIZE]
+            max_post_ids = db.session.query(Post.project_id, func.max(Post.post_id)).filter(
+                Post.project_id.in_(chunk)).group_by(Post.project_id)
+            updates = [{'b_id': project_id, 'b_next_post_id': max_post_id + 1}
+                       for project_id, max_post_id in max_post_ids]
+            if updates:
+                db.session.execute(Project.__table__.update().where(Project.id == bindparam('b_id')).values(
+                    next_post_id=bindparam('b_next_post_id')), updates)
+            db.session.commit()
+
+        elapsed = time.time() - self.started
+        print('[INFO] Finished: %d rows imported, %d skipped, in %.1fs.' % (self.inserted, self.skipped, elapsed),
+              file=sys.stderr)
+
+
+def import_():
+    """Bulk import projects and posts from an NDJSON export or a directory of markdown files."""
+
+    parser = ArgumentParser()
+    parser.add_argument("path", help="NDJSON file or directory of markdown files to import")
+    parser.add_argument("-u", "--username", dest="username",
+                        help="user to import projects for, required for markdown, overrides the users in NDJSON")
+    parser.add_argument("-c", "--chunk-size", dest="chunk_size", type=int, default=1000,
+                        help="number of rows to insert per transaction")
+    parser.add_argument("--skip-html", dest="skip_html", action="store_true",
+                        help="don't render html while importing, run scripts/render_html.py later instead")
+
+    args = parser.parse_args()
+
+    user_id = None
+    if args.username is not None:
+        user = User.query.filter_by(username=args.username).first()
+        if user is None:
+            print('[ERROR] User with username %s does not exist.' % args.username)
+            return
+        user_id = user.id
+
+    if os.path.isdir(args.path):
+        if user_id is None:
+            print('[ERROR] A username is required to import a directory of markdown files.')
+            return
+        records = read_markdown_directory(args.path)
+    else:
+        records = read_ndjson(args.path)
+
+    importer = Importer(user_id=user_id, chunk_size=args.chunk_size, render_html=not args.skip_html)
+    for record in records:
+        importer.add(record)
+    importer.finish()
+
+    return
+
+if __name__ == '__main__':
+    with create_app().app_context():
+        import_()
@@ -14,10 +14,10 @@ from flask_migrate import Migrate, MigrateCommand
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
-from projects import app, db
+from projects import create_app, db
 
 
-app.config.from_object('config')
+app = create_app()
 migrate = Migrate(app, db)
 manager = Manager(app)
 manager.add_command('db', MigrateCommand)
@@ -0,0 +1,42 @@
+import datetime
+import sys
+import os
+from argparse import ArgumentParser
+from flask import current_app
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from projects import create_app, db
+from projects.changes import purge_tombstones
+from projects.models import Project
+
+
+def purge_deleted():
+    """Purge the rows of projects that were soft deleted but not purged, and expired deletion records."""
+
+    parser = ArgumentParser()
+    parser.add_argument("-b", "--batch-size", dest="batch_size", type=int,
+                        default=current_app.config.get('DELETE_BATCH_SIZE', 1000),
+                        help="number of posts to delete per transaction")
+
+    args = parser.parse_args()
+
+    project_ids = [project_id for project_id, in
+                   db.session.query(Project.id).filter(Project.deleted.isnot(None)).all()]
+
+    for project_id in project_ids:
+        Project.purge_project(project_id, batch_size=args.batch_size)
+
+    print('[INFO] Purged %d deleted projects.' % len(project_ids))
+
+    # the API change feed refuses cursors older than this, so it no longer needs these
+    retention = datetime.timedelta(days=current_app.config.get('CHANGES_RETENTION_DAYS', 30))
+    count = purge_tombstones(datetime.datetime.now() - retention)
+
+    print('[INFO] Purged %d expired deletion records.' % count)
+
+    return
+
+if __name__ == '__main__':
+    with create_app().app_context():
+        purge_deleted()
@@ -0,0 +1,49 @@
+import sys
+import os
+from argparse import ArgumentParser
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from projects import create_app, db
+from projects.helpers import render_markdown
+from projects.models import Project, Post
+
+
+def render_html():
+    """Backfill the pre-rendered html bodies of existing projects and posts."""
+
+    parser = ArgumentParser()
+    parser.add_argument("-a", "--all", dest="all", action="store_true",
+                        help="re-render every row, not just those missing html")
+    parser.add_argument("-b", "--batch-size", dest="batch_size", type=int, default=500,
+                        help="number of rows to render before each commit")
+
+    args = parser.parse_args()
+
+    for model in (Project, Post):
+        query = model.query.order_by(model.id)
+        if not args.all:
+            query = query.filter(model.body_html.is_(None))
+
+        count = 0
+        last_id = 0
+        while True:
+            # page through by primary key so committed rows don't shift the window
+            rows = query.filter(model.id > last_id).limit(args.batch_size).all()
+            if not rows:
+                break
+
+            for row in rows:
+                row.body_html = render_markdown(row.body)
+            last_id = rows[-1].id
+            count += len(rows)
+
+            db.session.commit()
+
+        print('[INFO] Rendered html for %d rows in %s table.' % (count, model.__tablename__))
+
+    return
+
+if __name__ == '__main__':
+    with create_app().app_context():
+        render_html()
@@ -0,0 +1,46 @@
+import sys
+import os
+import time
+from argparse import ArgumentParser
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from projects import create_app, db, search
+from projects.tasks import run_pending_jobs
+
+
+def worker():
+    """Run background jobs from the jobs table, polling for new ones until interrupted."""
+
+    parser = ArgumentParser()
+    parser.add_argument("-i", "--poll-interval", dest="poll_interval", type=float, default=1.0,
+                        help="seconds to wait before looking for new jobs when there are none")
+    parser.add_argument("--once", dest="once", action="store_true",
+                        help="run the jobs that are due and exit, instead of polling")
+
+    args = parser.parse_args()
+
+    # jobs update the search index, which is created on a connection of its own rather than inside a job
+    search.create_index()
+
+    while True:
+        try:
+            count = run_pending_jobs()
+            if count:
+                print('[INFO] Ran %d jobs.' % count)
+        except Exception as e:
+            print('[ERROR]: ', e)
+            db.session.rollback()
+            count = 0
+        finally:
+            db.session.remove()
+
+        if args.once:
+            return
+
+        if not count:
+            time.sleep(args.poll_interval)
+
+if __name__ == '__main__':
+    with create_app().app_context():
+        worker()